@@ -1,24 +1,85 @@
+import asyncio
+import hashlib
+import importlib
 import logging
 import os
-from typing import Optional
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, AsyncIterator, Callable, List, Optional, TypeVar
 
+import httpx
+from fastapi import HTTPException
 from openai import OpenAI
 
-from .config import GOOGLE_API_KEY, OPENAI_API_KEY
+from .config import AI_MODE, GEMINI_MAX_CONCURRENCY, GOOGLE_API_KEY, OPENAI_API_KEY
 
 
 gemini_model = None  # type: Optional[object]
+gemini_fast_model = None  # type: Optional[object]
+GEMINI_FAST_MODEL_NAME = 'gemini-2.0-flash-lite'
+
+# OpenAI 共用連線池（keep-alive 重用 TLS 連線）
+OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+OPENAI_HTTP_TIMEOUT = 30.0
 _openai_client = None
 
+# Gemini 回應快取：同一份逐字稿／摘要重複送出（重新摘要、重新標籤）時直接回傳先前結果
+GEMINI_CACHE_MAX_ENTRIES = 512
+GEMINI_CACHE_TTL_SECONDS = 3600
+_WHITESPACE = re.compile(r"\s+")
+_gemini_response_cache = OrderedDict()  # key -> (到期時間, 回應文字)
+
+# 暫時性錯誤（配額 429、服務暫停 503、逾時）重試：指數退避加隨機抖動；
+# 配額錯誤重試耗盡後熔斷一段時間，期間所有 Gemini 請求（摘要與驗證）直接回 429 不再排隊等待
+GEMINI_RETRY_ATTEMPTS = 3
+GEMINI_BACKOFF_BASE_SECONDS = 1.0
+GEMINI_BACKOFF_MAX_SECONDS = 8.0
+GEMINI_QUOTA_COOLDOWN_SECONDS = 30.0
+_RETRYABLE_ERROR_MARKERS = ("429", "quota", "resource exhausted", "503", "unavailable")
+_QUOTA_ERROR_MARKERS = ("429", "quota", "resource exhausted")
+
+# 單次 Gemini 呼叫（串流為取得首個片段）的逾時
+GEMINI_CALL_TIMEOUT_SECONDS = 30
+
+_T = TypeVar("_T")
+
+# 同時進行中的 Gemini 生成請求上限（GEMINI_MAX_CONCURRENCY）；超出者排隊等待，避免尖峰時一次耗盡每分鐘配額
+_gemini_semaphore = None  # type: Optional[asyncio.Semaphore]
+
+# 離線批次生成（Gemini Batch API）：費用約為即時呼叫的一半，最長 24 小時完成；需安裝 google-genai 套件
+GEMINI_BATCH_MODEL_NAME = 'gemini-2.0-flash'
+GEMINI_BATCH_POLL_INTERVAL_SECONDS = 60
+# 等待批次工作的上限；逾時後工作仍在雲端執行，可再以工作名稱呼叫 wait_gemini_batch 續接
+GEMINI_BATCH_MAX_WAIT_SECONDS = 24 * 60 * 60
+GEMINI_BATCH_TERMINAL_STATES = frozenset({'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'})
+_genai_batch_client = None
+
+# google.generativeai 匯入成本高（會載入 gRPC），僅在真正需要時才匯入
+_genai = None
+_ai_sdks_initialized = False
+
+
+def _get_genai():
+    global _genai
+    if _genai is None:
+        _genai = importlib.import_module("google.generativeai")
+    return _genai
+
 
 def init_ai_sdks():
-    global gemini_model
+    global gemini_model, gemini_fast_model, _ai_sdks_initialized
+    _ai_sdks_initialized = True
+    if AI_MODE == "regex_only":
+        logging.info("AI_MODE=regex_only，略過 Gemini SDK 載入。")
+        return False
     try:
         if not GOOGLE_API_KEY:
             raise ValueError("GOOGLE_API_KEY 環境變數未設定")
         
         # 使用最新版 API（適配 0.8.5）
-        import google.generativeai as genai
+        genai = _get_genai()
         genai.configure(api_key=GOOGLE_API_KEY)
         
         # 測試連接 - 使用最新的 Gemini 2.0 模型
@@ -39,23 +100,260 @@ def init_ai_sdks():
                 logging.error(f"所有 Gemini 2.0 模型都無法使用: {e2}")
                 raise e2
         
+        # 輕量模型：用於高亮、遺漏檢查等較不易出錯的驗證
+        try:
+            gemini_fast_model = genai.GenerativeModel(GEMINI_FAST_MODEL_NAME)
+            logging.info(f"Gemini 輕量模型已設定為: {GEMINI_FAST_MODEL_NAME}")
+        except Exception as e:
+            logging.warning(f"無法使用 {GEMINI_FAST_MODEL_NAME}，輕量驗證改用主模型: {e}")
+            gemini_fast_model = gemini_model
+        
         # 驗證模型是否正確設定
         logging.info(f"模型驗證: {gemini_model is not None}")
         return True
     except Exception as e:
         gemini_model = None
+        gemini_fast_model = None
         logging.error(f"無法設定 AI SDKs: {e}")
         logging.error(f"詳細錯誤: {str(e)}")
         return False
 
 
+def get_gemini_model():
+    """取得 Gemini 主模型；尚未初始化時才載入 SDK"""
+    if not _ai_sdks_initialized:
+        init_ai_sdks()
+    return gemini_model
+
+
+def get_gemini_fast_model():
+    """取得 Gemini 輕量模型；尚未初始化時才載入 SDK"""
+    if not _ai_sdks_initialized:
+        init_ai_sdks()
+    return gemini_fast_model
+
+
 def get_openai_client() -> OpenAI:
     global _openai_client
     if _openai_client is None:
         api_key = OPENAI_API_KEY or os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("OPENAI_API_KEY 環境變數未設定")
-        _openai_client = OpenAI(api_key=api_key)
+        _openai_client = OpenAI(
+            api_key=api_key,
+            http_client=httpx.Client(limits=OPENAI_HTTP_LIMITS, timeout=OPENAI_HTTP_TIMEOUT),
+        )
     return _openai_client
 
 
+def _normalize_prompt(prompt: str) -> str:
+    """將空白正規化，使僅縮排或換行不同的提示共用同一快取鍵"""
+    return _WHITESPACE.sub(" ", prompt).strip()
+
+
+def _cache_key(model, prompt: str, cache_ns: str) -> str:
+    digest = hashlib.sha256(_normalize_prompt(prompt).encode("utf-8")).hexdigest()
+    return f"{cache_ns}:{getattr(model, 'model_name', '')}:{digest}"
+
+
+def _cache_lookup(key: str) -> Optional[str]:
+    entry = _gemini_response_cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        del _gemini_response_cache[key]
+        return None
+    _gemini_response_cache.move_to_end(key)
+    return entry[1]
+
+
+def _cache_store(key: str, text: str) -> None:
+    _gemini_response_cache[key] = (time.monotonic() + GEMINI_CACHE_TTL_SECONDS, text)
+    while len(_gemini_response_cache) > GEMINI_CACHE_MAX_ENTRIES:
+        _gemini_response_cache.popitem(last=False)
+
+
+def get_gemini_semaphore() -> asyncio.Semaphore:
+    """全行程共用的 Gemini 並行限制，ai_agent 的驗證呼叫亦使用同一個"""
+    # 延遲建立：Python 3.9 的 Semaphore 會綁定建立當下的事件迴圈，須在 uvicorn 的迴圈內建立
+    global _gemini_semaphore
+    if _gemini_semaphore is None:
+        _gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+    return _gemini_semaphore
+
+
+async def cached_generate(model, prompt: str, cache_ns: str) -> str:
+    """以正規化提示的雜湊快取 Gemini 回應文字（LRU + TTL）；僅快取成功的回應"""
+    key = _cache_key(model, prompt, cache_ns)
+    cached = _cache_lookup(key)
+    if cached is not None:
+        return cached
+    async with get_gemini_semaphore():
+        # 排隊期間相同提示可能已由先前的請求完成，取得名額後再查一次快取
+        cached = _cache_lookup(key)
+        if cached is not None:
+            return cached
+        # 限時呼叫，避免卡住的請求長期佔用並行名額；逾時由 retry_gemini 視為可重試錯誤
+        response = await asyncio.wait_for(model.generate_content_async(prompt), timeout=GEMINI_CALL_TIMEOUT_SECONDS)
+    text = response.text
+    _cache_store(key, text)
+    return text
+
+
+async def stream_generate(model, prompt: str, cache_ns: str) -> AsyncIterator[str]:
+    """串流產生 Gemini 回應片段；快取命中時一次送出，完整串流結束後才寫入快取"""
+    key = _cache_key(model, prompt, cache_ns)
+    cached = _cache_lookup(key)
+    if cached is not None:
+        yield cached
+        return
+    parts = []
+    async with get_gemini_semaphore():
+        response = await start_gemini_stream(model, prompt)
+        async for chunk in response:
+            text = chunk.text
+            if text:
+                parts.append(text)
+                yield text
+    _cache_store(key, "".join(parts))
+
+
+class QuotaBreaker:
+    """Gemini 配額熔斷器：跳脫後的冷卻期間內直接拒絕請求"""
+
+    def __init__(self, cooldown_seconds: float):
+        self.cooldown_seconds = cooldown_seconds
+        self.tripped_until = 0.0
+
+    def is_open(self) -> bool:
+        return time.monotonic() < self.tripped_until
+
+    def trip(self) -> None:
+        self.tripped_until = time.monotonic() + self.cooldown_seconds
+
+
+gemini_quota_breaker = QuotaBreaker(GEMINI_QUOTA_COOLDOWN_SECONDS)
+
+
+def _is_quota_error(error: Exception) -> bool:
+    message = str(error).lower()
+    return any(marker in message for marker in _QUOTA_ERROR_MARKERS)
+
+
+def _is_retryable_gemini_error(error: Exception) -> bool:
+    """判斷 Gemini 錯誤是否為暫時性（400 等請求錯誤不重試）"""
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in _RETRYABLE_ERROR_MARKERS)
+
+
+def _raise_quota_exhausted(error: Exception) -> None:
+    gemini_quota_breaker.trip()
+    logging.error(f"Gemini API 配額已用完，熔斷 {GEMINI_QUOTA_COOLDOWN_SECONDS:.0f} 秒: {error}")
+    raise HTTPException(status_code=429, detail="AI 服務配額已用完，請稍後再試") from error
+
+
+async def retry_gemini(make_call: Callable[[], Awaitable[_T]]) -> _T:
+    """
+    所有 Gemini 呼叫共用的重試與熔斷：暫時性錯誤以指數退避加抖動重試；
+    熔斷中或配額錯誤重試耗盡時回 429（並跳脫熔斷器），其餘錯誤原樣拋出
+    """
+    for attempt in range(GEMINI_RETRY_ATTEMPTS):
+        if gemini_quota_breaker.is_open():
+            raise HTTPException(status_code=429, detail="AI 服務配額已用完，請稍後再試")
+        try:
+            return await make_call()
+        except Exception as e:
+            if not _is_retryable_gemini_error(e):
+                raise
+            if attempt == GEMINI_RETRY_ATTEMPTS - 1:
+                if _is_quota_error(e):
+                    _raise_quota_exhausted(e)
+                raise
+            delay = min(GEMINI_BACKOFF_BASE_SECONDS * 2 ** attempt, GEMINI_BACKOFF_MAX_SECONDS) * random.uniform(0.5, 1.5)
+            logging.warning(f"Gemini 暫時性錯誤，等待 {delay:.1f} 秒後重試 (嘗試 {attempt + 1}/{GEMINI_RETRY_ATTEMPTS}): {e}")
+            await asyncio.sleep(delay)
+
+
+async def start_gemini_stream(model, prompt: str):
+    """
+    開啟 Gemini 串流並等待首個片段（逾時 GEMINI_CALL_TIMEOUT_SECONDS）；熔斷中回 429，
+    配額錯誤時跳脫熔斷器。串流不重試，呼叫端須在整個串流期間持有 get_gemini_semaphore() 名額
+    """
+    if gemini_quota_breaker.is_open():
+        raise HTTPException(status_code=429, detail="AI 服務配額已用完，請稍後再試")
+    try:
+        return await asyncio.wait_for(
+            model.generate_content_async(prompt, stream=True), timeout=GEMINI_CALL_TIMEOUT_SECONDS
+        )
+    except Exception as e:
+        if _is_quota_error(e):
+            _raise_quota_exhausted(e)
+        raise
+
+
+async def call_gemini_with_retry(model, prompt: str, cache_ns: str) -> str:
+    """呼叫 Gemini（含回應快取），經共用的重試與熔斷機制；重試耗盡或熔斷中回 429"""
+    cached = _cache_lookup(_cache_key(model, prompt, cache_ns))
+    if cached is not None:
+        return cached
+    return await retry_gemini(lambda: cached_generate(model, prompt, cache_ns))
+
+
+def _get_genai_batch_client():
+    global _genai_batch_client
+    if _genai_batch_client is None:
+        try:
+            from google import genai
+        except ImportError as e:
+            raise RuntimeError("Gemini Batch API 需要安裝 google-genai 套件") from e
+        if not GOOGLE_API_KEY:
+            raise ValueError("GOOGLE_API_KEY 環境變數未設定")
+        _genai_batch_client = genai.Client(api_key=GOOGLE_API_KEY)
+    return _genai_batch_client
+
+
+def submit_gemini_batch(prompts: List[str], display_name: str) -> str:
+    """將多個提示以 inline 方式送交 Gemini Batch API，回傳批次工作名稱（同步呼叫，請於執行緒中使用）"""
+    client = _get_genai_batch_client()
+    inlined_requests = [
+        {'contents': [{'parts': [{'text': prompt}], 'role': 'user'}]}
+        for prompt in prompts
+    ]
+    batch_job = client.batches.create(
+        model=GEMINI_BATCH_MODEL_NAME,
+        src=inlined_requests,
+        config={'display_name': display_name},
+    )
+    logging.info(f"已送出 Gemini 批次工作: {batch_job.name}（{len(prompts)} 筆）")
+    return batch_job.name
+
+
+async def wait_gemini_batch(job_name: str, max_wait_seconds: float = GEMINI_BATCH_MAX_WAIT_SECONDS) -> List[Optional[str]]:
+    """輪詢批次工作直到結束，依送出順序回傳各項回應文字；個別失敗的項目為 None
+
+    超過 max_wait_seconds 仍未結束時拋出 TimeoutError，工作名稱會記錄於日誌以便稍後續接。
+    """
+    client = _get_genai_batch_client()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_wait_seconds
+    batch_job = await asyncio.to_thread(client.batches.get, name=job_name)
+    while batch_job.state.name not in GEMINI_BATCH_TERMINAL_STATES:
+        if loop.time() >= deadline:
+            logging.warning(f"等待 Gemini 批次工作逾時: {job_name}（狀態 {batch_job.state.name}），可稍後以工作名稱續接")
+            raise TimeoutError(f"Gemini 批次工作 {job_name} 於 {max_wait_seconds} 秒內未完成")
+        await asyncio.sleep(GEMINI_BATCH_POLL_INTERVAL_SECONDS)
+        batch_job = await asyncio.to_thread(client.batches.get, name=job_name)
+
+    if batch_job.state.name != 'JOB_STATE_SUCCEEDED':
+        raise RuntimeError(f"Gemini 批次工作 {job_name} 未成功: {batch_job.state.name}")
+
+    results = []
+    for inline_response in batch_job.dest.inlined_responses:
+        if inline_response.error:
+            logging.error(f"Gemini 批次項目失敗: {inline_response.error}")
+            results.append(None)
+        else:
+            results.append(inline_response.response.text)
+    return results
@@ -1,9 +1,234 @@
+import asyncio
+import bisect
+import functools
+import hashlib
+import itertools
 import logging
 import re
 import json
-from typing import Dict, List, Any, Optional, Tuple
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Any, Optional, Tuple
 from dataclasses import dataclass
 from enum import Enum
+from types import MappingProxyType
+
+from .ai import (
+    GEMINI_CALL_TIMEOUT_SECONDS,
+    get_gemini_semaphore,
+    retry_gemini,
+    start_gemini_stream,
+    submit_gemini_batch,
+    wait_gemini_batch,
+)
+
+
+# 預先編譯的正則表達式（避免每次呼叫重新查找快取）
+_JSON_FENCE_OPEN = re.compile(r'```json\s*')
+_JSON_FENCE_CLOSE = re.compile(r'```\s*$')
+
+# 單一交替式樣一次掃描所有生命徵象數值，依 lastgroup 分派
+_COMBINED_VITALS = re.compile(
+    r'(?P<bp>血壓[：:]?\s*(?P<bp_sys>\d+)/(?P<bp_dia>\d+))'
+    r'|(?P<hr>心率[：:]?\s*(?P<hr_val>\d+))'
+    r'|(?P<temp>體溫[：:]?\s*(?P<temp_val>\d+\.?\d*))'
+    r'|(?P<bs>血糖[：:]?\s*(?P<bs_val>\d+\.?\d*))'
+)
+
+# 提示範本：JSON 結構以單行緊湊格式撰寫以減少輸入 token，於呼叫時以 str.format 填入內容
+_SEVERITY_SCHEMA = '"severity":"low|medium|high|critical"'
+_FORMAT_RULES = (
+    "Markdown 規則：絕對禁止更動 Markdown 結構（「## 看診重點摘要」標題、「**看診原因**」等粗體小標、換行與空行）；"
+    "僅允許句內最小範圍替換；original_text 必須是摘要中實際存在的文字，original_text 與 correct_text 皆不得含換行字元。"
+)
+_MODIFICATION_SCHEMA = (
+    '{{"type":"replace|highlight|remove","title":"錯誤標題","description":"發現的具體錯誤",'
+    '"original_text":"摘要中需修改的文字","correct_text":"應替換成的正確文字","reason":"錯誤原因",'
+    '"severity":"critical|high|medium|low",'
+    '"category":"hallucination|fact_error|value_error|time_error|diagnosis_error|treatment_error",'
+    '"start":起始位置,"end":結束位置}}'
+)
+_FACT_ISSUE_SCHEMA = (
+    '{{"type":"symptom_mismatch|value_error|diagnosis_inconsistency|treatment_unfounded",'
+    + _SEVERITY_SCHEMA + ',"description":"具體問題描述","suggestion":"具體改善建議"}}'
+)
+_HIGHLIGHT_SCHEMA = (
+    '{{"text":"關鍵資訊","start_pos":起始位置,"end_pos":結束位置,'
+    '"category":"vital_signs|lab_values|medications|symptoms|diagnosis|treatment",'
+    '"confidence":0.0-1.0,"importance":"low|medium|high|critical"}}'
+)
+_MISSING_ITEM_SCHEMA = (
+    '{{"type":"symptom|vital_sign|allergy|medical_history|family_history|social_history",'
+    + _SEVERITY_SCHEMA + ',"description":"缺漏的具體資訊內容","suggestion":"如何補充"}}'
+)
+_TRANSCRIPT_AND_SUMMARY = "逐字稿：\n---\n{transcript}\n---\n摘要：\n---\n{summary}\n---\n"
+
+_PROMPT_TEMPLATES = {
+    'unified': (
+        "你是醫療摘要品質控制專家。比較逐字稿與摘要，一次完成四項檢查：\n"
+        "1. fact_consistency：症狀、數值、診斷、治療計畫是否與逐字稿一致。\n"
+        "2. highlights：摘要中的關鍵醫療資訊（生命徵象、檢驗值、藥物劑量、症狀、診斷、治療）及字元位置。\n"
+        "3. missing_items：遺漏的重要資訊（症狀細節、生命徵象、過敏史、既往病史、家族史、社會史）。\n"
+        "4. modifications：用詞、細節、事實、數值、時間差異的句內最小替換；幻覺用 remove，事實錯誤用 replace。\n"
+        + _FORMAT_RULES + "\n"
+        + _TRANSCRIPT_AND_SUMMARY
+        + "僅回傳 JSON（繁體中文），無問題的區段回傳空陣列：\n"
+        '{{"fact_consistency":{{"consistency_score":0-100,"issues":[' + _FACT_ISSUE_SCHEMA + ']}},'
+        '"highlights":[' + _HIGHLIGHT_SCHEMA + '],'
+        '"missing_items":[' + _MISSING_ITEM_SCHEMA + '],'
+        '"modifications":[' + _MODIFICATION_SCHEMA + ']}}'
+    ),
+    'fact_consistency': (
+        "你是醫療摘要品質控制專家。檢查摘要是否與逐字稿一致：症狀描述、數值、診斷建議是否基於原始內容、治療計畫是否合理。\n"
+        + _TRANSCRIPT_AND_SUMMARY
+        + "僅回傳 JSON（繁體中文）：\n"
+        '{{"consistency_score":0-100,"issues":[' + _FACT_ISSUE_SCHEMA + ']}}'
+    ),
+    'highlights': (
+        "你是醫療資訊專家。從摘要中識別關鍵醫療資訊：生命徵象、檢驗值、藥物名稱與劑量、重要症狀、診斷、治療建議。\n"
+        "摘要：\n---\n{summary}\n---\n"
+        "僅回傳 JSON（繁體中文）：\n"
+        '{{"highlights":[' + _HIGHLIGHT_SCHEMA + ']}}'
+    ),
+    'missing_information': (
+        "你是醫療品質控制專家。檢查摘要是否遺漏重要資訊並具體說明缺漏內容："
+        "症狀細節（持續時間、嚴重程度）、生命徵象（血壓、心率、體溫、呼吸、血氧）、藥物過敏史、既往病史、家族病史、社會史（菸酒、職業、生活習慣）。\n"
+        + _TRANSCRIPT_AND_SUMMARY
+        + "僅回傳 JSON（繁體中文）：\n"
+        '{{"missing_items":[' + _MISSING_ITEM_SCHEMA + ']}}'
+    ),
+    'modifications': (
+        "你是醫療摘要審核專家。積極比較逐字稿與摘要，即使很小的差異也要回報："
+        "用詞差異、遺漏細節、語氣不一致、事實不一致、數值錯誤、時間錯誤。幻覺用 remove，事實錯誤用 replace。\n"
+        + _FORMAT_RULES + "\n"
+        + _TRANSCRIPT_AND_SUMMARY
+        + "僅回傳 JSON（繁體中文），沒有發現錯誤時回傳 {{\"modifications\":[]}}：\n"
+        '{{"modifications":[' + _MODIFICATION_SCHEMA + ']}}'
+    ),
+}
+
+
+# 合併提示回應的頂層鍵 -> 驗證結果中的區段名稱
+_UNIFIED_SECTIONS = {
+    'fact_consistency': 'fact_consistency',
+    'highlights': 'highlights',
+    'missing_items': 'missing_alerts',
+    'modifications': 'modifications',
+}
+
+# 逐字稿超過此長度時，輕量驗證改用主模型
+FAST_MODEL_MAX_TRANSCRIPT_CHARS = 4000
+
+# 幻覺檢測關鍵詞：摘要提到但逐字稿未出現時標記
+HALLUCINATION_KEY_TERMS = ('診斷', '治療', '藥物', '手術', '檢查')
+
+
+def _shingles(text: str, n: int = 2) -> frozenset:
+    """取得文字的 n-gram 集合"""
+    return frozenset(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+_TERM_SHINGLES = {term: _shingles(term) for term in HALLUCINATION_KEY_TERMS}
+
+# 批次驗證設定（Batch API 模式的模型與輪詢設定沿用 app.ai）
+BATCH_REALTIME_CONCURRENCY = 4
+
+# 驗證結果快取：相同 (逐字稿, 摘要, 提示版本) 直接重用先前的 LLM 結果
+PROMPT_VERSION = "v2"
+_MAX_CACHE = 256
+_validation_cache: "OrderedDict[str, Any]" = OrderedDict()
+
+
+def _cache_key(method_name: str, *parts: str) -> str:
+    """以 blake2b 雜湊產生快取鍵"""
+    raw = "\x00".join((*parts, method_name, PROMPT_VERSION))
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+
+def _cache_get(key: str) -> Optional[Any]:
+    """讀取快取並更新為最近使用"""
+    value = _validation_cache.get(key)
+    if value is not None:
+        _validation_cache.move_to_end(key)
+    return value
+
+
+def _cache_put(key: str, value: Any) -> None:
+    """寫入快取，超過容量時淘汰最久未使用的項目"""
+    _validation_cache[key] = value
+    _validation_cache.move_to_end(key)
+    if len(_validation_cache) > _MAX_CACHE:
+        _validation_cache.popitem(last=False)
+
+
+async def _call_gemini(gemini_model, prompt: str):
+    """限制並行數並加上逾時的 Gemini 呼叫，避免瞬間大量請求觸發 429"""
+    async with get_gemini_semaphore():
+        return await asyncio.wait_for(gemini_model.generate_content_async(prompt), timeout=GEMINI_CALL_TIMEOUT_SECONDS)
+
+
+async def _gemini_with_retry(gemini_model, prompt: str):
+    """呼叫 Gemini；重試、退避與配額熔斷與摘要端點共用 app.ai.retry_gemini"""
+    return await retry_gemini(lambda: _call_gemini(gemini_model, prompt))
+
+
+@functools.lru_cache(maxsize=32)
+def _split_sentences(summary: str) -> Tuple[str, ...]:
+    """以句號切分摘要並略過空白句（同一摘要會在多個檢查中重複使用）"""
+    return tuple(sentence for sentence in summary.split('。') if sentence.strip())
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _extract_json(text: str) -> Dict[str, Any]:
+    """從 LLM 回應文字中解析 JSON 物件（容忍 markdown 圍欄與前後說明文字）"""
+    text = text.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    json_start = text.find('{')
+    if json_start != -1:
+        try:
+            result, _ = _JSON_DECODER.raw_decode(text, json_start)
+            return result
+        except json.JSONDecodeError:
+            pass
+    
+    # 退回原本的清理流程：擷取第一個 { 到最後一個 } 並移除 markdown 格式
+    json_end = text.rfind('}') + 1
+    if json_start != -1 and json_end > json_start:
+        json_text = text[json_start:json_end]
+    else:
+        json_text = text
+    json_text = _JSON_FENCE_OPEN.sub('', json_text)
+    json_text = _JSON_FENCE_CLOSE.sub('', json_text)
+    return json.loads(json_text.strip())
+
+
+
+def _parse_completed_top_level_items(text: str, pos: int) -> Tuple[List[Tuple[str, Any]], int]:
+    """從仍在接收中的 JSON 物件文字解析已完整的頂層鍵值
+    
+    pos 為上次停止的位置（位於 '{' 之後）；回傳 (已完成的鍵值列表, 下次開始位置)。
+    """
+    items = []
+    length = len(text)
+    while True:
+        while pos < length and text[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= length or text[pos] != '"':
+            return items, pos
+        try:
+            key, colon_pos = _JSON_DECODER.raw_decode(text, pos)
+            colon_pos = text.index(':', colon_pos) + 1
+            while colon_pos < length and text[colon_pos] in ' \t\r\n':
+                colon_pos += 1
+            value, end = _JSON_DECODER.raw_decode(text, colon_pos)
+        except ValueError:
+            # 鍵或值尚未接收完整，等待下一個片段
+            return items, pos
+        # 值位於緩衝區結尾時可能是被截斷的數字，等後續字元確認
+        if end >= length:
+            return items, pos
+        items.append((key, value))
+        pos = end
 
 
 class ValidationLevel(Enum):
@@ -45,355 +270,445 @@ class AnomalyDetection:
     position: Tuple[int, int]
 
 
+def _make_vital_check(ranges: Dict[str, Tuple[float, float]], normal_range: str, suggestion: str, parse):
+    """建立單一生命徵象的檢查函數，超出正常範圍即標記，超出危急範圍為 high"""
+    normal_low, normal_high = ranges['normal']
+    critical_low, critical_high = ranges['critical']
+    
+    def check(match, anomalies: List[AnomalyDetection]) -> None:
+        value, display = parse(match)
+        if not (normal_low <= value <= normal_high):
+            anomalies.append(AnomalyDetection(
+                value=display,
+                normal_range=normal_range,
+                severity="high" if value > critical_high or value < critical_low else "medium",
+                suggestion=suggestion,
+                position=(match.start(), match.end())
+            ))
+    
+    return check
+
+
 class MedicalSummaryValidator:
     """醫療摘要驗證 AI Agent"""
     
-    def __init__(self):
-        self.gemini_model = None
-        self.medical_patterns = {
-            'vital_signs': r'(血壓|血壓值|收縮壓|舒張壓|心率|心跳|呼吸|體溫|體溫值|脈搏)',
-            'lab_values': r'(血糖|血糖值|膽固醇|血紅素|白血球|紅血球|血小板|肌酸酐|尿素氮|肝功能|腎功能)',
-            'medications': r'(藥物|藥品|處方|用藥|劑量|毫克|mg|公克|g|毫升|ml)',
-            'symptoms': r'(症狀|徵象|不適|疼痛|發燒|頭痛|胸痛|腹痛|噁心|嘔吐|腹瀉|便秘)',
-            'diagnosis': r'(診斷|診斷結果|診斷為|疑似|可能|確診|排除)',
-            'treatment': r'(治療|療程|手術|開刀|住院|出院|復健|追蹤)'
-        }
-        
-        self.critical_values = {
-            'blood_pressure': {'normal': (90, 140), 'critical': (60, 180)},
-            'heart_rate': {'normal': (60, 100), 'critical': (40, 150)},
-            'temperature': {'normal': (36.0, 37.5), 'critical': (35.0, 40.0)},
-            'blood_sugar': {'normal': (70, 140), 'critical': (50, 300)}
-        }
+    __slots__ = ("gemini_model", "gemini_fast_model")
+    
+    # 唯讀查找表，所有實例共用
+    CRITICAL_VALUES = MappingProxyType({
+        'blood_pressure': MappingProxyType({'normal': (90, 140), 'critical': (60, 180)}),
+        'heart_rate': MappingProxyType({'normal': (60, 100), 'critical': (40, 150)}),
+        'temperature': MappingProxyType({'normal': (36.0, 37.5), 'critical': (35.0, 40.0)}),
+        'blood_sugar': MappingProxyType({'normal': (70, 140), 'critical': (50, 300)})
+    })
+    
+    # 異常數值分派表：_COMBINED_VITALS 的群組名稱 -> 檢查函數
+    VITAL_CHECKS = MappingProxyType({
+        'bp': _make_vital_check(
+            CRITICAL_VALUES['blood_pressure'], "90-140/60-90", "請確認血壓數值是否正確",
+            lambda m: (int(m.group('bp_sys')), f"{int(m.group('bp_sys'))}/{int(m.group('bp_dia'))}")
+        ),
+        'hr': _make_vital_check(
+            CRITICAL_VALUES['heart_rate'], "60-100", "請確認心率數值是否正確",
+            lambda m: (int(m.group('hr_val')), str(int(m.group('hr_val'))))
+        ),
+        'temp': _make_vital_check(
+            CRITICAL_VALUES['temperature'], "36.0-37.5°C", "請確認體溫數值是否正確",
+            lambda m: (float(m.group('temp_val')), str(float(m.group('temp_val'))))
+        ),
+        'bs': _make_vital_check(
+            CRITICAL_VALUES['blood_sugar'], "70-140 mg/dL", "請確認血糖數值是否正確",
+            lambda m: (float(m.group('bs_val')), str(float(m.group('bs_val'))))
+        ),
+    })
     
+    def __init__(self, model_fast: Optional[object] = None, model_strong: Optional[object] = None):
+        # 強模型用於事實一致性與修改建議；輕量模型用於高亮與遺漏檢查
+        self.gemini_model = model_strong
+        self.gemini_fast_model = model_fast
+    
+    def warm_up(self) -> None:
+        """啟動時預先綁定共用的 Gemini 模型，讓首個驗證請求不必承擔 SDK 初始化成本"""
+        self._get_gemini_model()
+        self._get_gemini_fast_model()
+
     def _get_gemini_model(self):
         """獲取 Gemini 模型，使用延遲導入"""
         if self.gemini_model is None:
-            from .ai import gemini_model
-            self.gemini_model = gemini_model
+            from .ai import get_gemini_model
+            self.gemini_model = get_gemini_model()
         return self.gemini_model
 
+    def _get_gemini_fast_model(self, transcript: str = ""):
+        """獲取輕量 Gemini 模型；逐字稿過長時升級為主模型"""
+        if len(transcript) > FAST_MODEL_MAX_TRANSCRIPT_CHARS:
+            return self._get_gemini_model()
+        if self.gemini_fast_model is None:
+            from .ai import get_gemini_fast_model
+            self.gemini_fast_model = get_gemini_fast_model()
+        return self.gemini_fast_model or self._get_gemini_model()
+
     async def validate_summary(self, transcript: str, summary: str) -> Dict[str, Any]:
-        """主要驗證函數"""
+        """主要驗證函數 - 以單一合併提示完成所有 LLM 檢查"""
         try:
-            # 1. 事實一致性校驗
-            fact_check_results = await self._fact_consistency_check(transcript, summary)
-            
-            # 2. 關鍵資訊高亮與驗證
-            highlight_results = await self._extract_and_highlight_key_info(summary)
-            
-            # 3. 潛在遺漏提醒
-            missing_alerts = await self._detect_missing_information(transcript, summary)
+            try:
+                sections = await self._unified_validation(transcript, summary)
+            except Exception as e:
+                # 合併提示失敗時退回逐項驗證
+                logging.warning(f"合併驗證失敗，改用逐項驗證: {e}")
+                return await self._validate_summary_per_section(transcript, summary)
             
-            # 4. 異常數值標記
-            anomaly_results = await self._detect_anomalous_values(summary)
-            
-            return {
-                'fact_consistency': fact_check_results,
-                'highlights': highlight_results,
-                'missing_alerts': missing_alerts,
-                'anomalies': anomaly_results,
-                'overall_score': self._calculate_overall_score(fact_check_results, missing_alerts, anomaly_results)
-            }
+            return await self._assemble_validation_result(summary, sections)
             
         except Exception as e:
             logging.error(f"摘要驗證失敗: {e}")
             return {'error': str(e)}
 
-    async def _fact_consistency_check(self, transcript: str, summary: str) -> List[ValidationResult]:
-        """事實一致性校驗"""
-        prompt = f"""
-        作為醫療摘要品質控制專家，請檢查以下摘要是否與原始對話逐字稿一致：
-
-        原始對話逐字稿：
-        ---
-        {transcript}
-        ---
-
-        生成的摘要：
-        ---
-        {summary}
-        ---
-
-        請檢查以下項目：
-        1. 症狀描述是否一致
-        2. 數值是否準確
-        3. 診斷建議是否基於原始內容
-        4. 治療計畫是否合理
-
-        請以 JSON 格式回傳結果，使用繁體中文：
-        {{
-            "consistency_score": 0-100,
-            "issues": [
-                {{
-                    "type": "symptom_mismatch|value_error|diagnosis_inconsistency|treatment_unfounded",
-                    "severity": "low|medium|high|critical",
-                    "description": "具體問題描述，請詳細說明哪裡不一致",
-                    "suggestion": "具體的改善建議，請說明如何修正"
-                }}
-            ]
-        }}
-        """
+    async def _assemble_validation_result(self, summary: str, sections: Dict[str, Any],
+                                          anomaly_results: Optional[List[AnomalyDetection]] = None) -> Dict[str, Any]:
+        """將合併提示的各區段結果與本地異常數值檢查組成驗證結果"""
+        # 異常數值標記為本地規則檢查，不需呼叫 LLM
+        if anomaly_results is None:
+            anomaly_results = await self._detect_anomalous_values(summary)
+        
+        return {
+            'fact_consistency': sections['fact_consistency'],
+            'highlights': sections['highlights'],
+            'missing_alerts': sections['missing_alerts'],
+            'anomalies': anomaly_results,
+            'modifications': sections['modifications'],
+            'overall_score': self._calculate_overall_score(sections['fact_consistency'], sections['missing_alerts'], anomaly_results)
+        }
 
+    async def validate_summaries_batch(self, pairs: List[Tuple[str, str]], mode: str = "realtime") -> List[Dict[str, Any]]:
+        """批次驗證多份摘要
+        
+        - realtime：以有限並行數即時呼叫 Gemini，適合需要立即結果的情境。
+        - batch：送交 Gemini Batch API（成本較低、最長 24 小時完成），適合夜間品質審查。
+        """
+        if mode == "realtime":
+            semaphore = asyncio.Semaphore(BATCH_REALTIME_CONCURRENCY)
+            
+            async def run(transcript: str, summary: str) -> Dict[str, Any]:
+                async with semaphore:
+                    return await self.validate_summary(transcript, summary)
+            
+            return await asyncio.gather(*(run(transcript, summary) for transcript, summary in pairs))
+        if mode == "batch":
+            return await self._validate_summaries_via_batch_api(pairs)
+        raise ValueError(f"不支援的批次模式: {mode}")
+
+    async def _validate_summaries_via_batch_api(self, pairs: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        """透過 Gemini Batch API 送出合併提示並將結果依序拆回"""
+        prompts = [self._build_unified_prompt(transcript, summary) for transcript, summary in pairs]
+        job_name = await asyncio.to_thread(submit_gemini_batch, prompts, f"summary-validation-{len(pairs)}")
+        texts = await wait_gemini_batch(job_name)
+        
+        results = []
+        for (transcript, summary), text in zip(pairs, texts):
+            anomaly_results = self._scan_vitals(summary)
+            try:
+                if text is None:
+                    raise ValueError(f"批次工作 {job_name} 中此項目失敗")
+                sections = self._parse_unified_response(_extract_json(text))
+                _cache_put(_cache_key("unified_validation", transcript, summary), sections)
+                results.append(await self._assemble_validation_result(summary, sections, anomaly_results))
+            except Exception as e:
+                logging.error(f"批次驗證結果解析失敗: {e}")
+                results.append({'error': str(e)})
+        return results
+
+    async def _validate_summary_per_section(self, transcript: str, summary: str) -> Dict[str, Any]:
+        """逐項驗證（合併提示的備用路徑）"""
+        # 三項 LLM 檢查彼此獨立，並行送出以縮短等待時間
+        fact_task = asyncio.create_task(self._fact_consistency_check(transcript, summary))
+        highlight_task = asyncio.create_task(self._extract_and_highlight_key_info(summary))
+        missing_task = asyncio.create_task(self._detect_missing_information(transcript, summary))
+        
+        # 異常數值標記為本地規則檢查
+        anomaly_results = await self._detect_anomalous_values(summary)
+        
+        # 單一檢查失敗時轉為該區段的錯誤結果，不影響其他區段；
+        # 失敗的區段記入 section_errors，結果標記為降級，呼叫端不應快取
+        section_errors = []
         try:
-            gemini_model = self._get_gemini_model()
-            if not gemini_model:
-                raise ValueError("Gemini 模型未能成功載入")
-            response = await gemini_model.generate_content_async(prompt)
-            
-            # 清理回應文字，提取 JSON 部分
-            response_text = response.text.strip()
-            
-            # 嘗試找到 JSON 部分
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            
-            if json_start != -1 and json_end > json_start:
-                json_text = response_text[json_start:json_end]
-            else:
-                json_text = response_text
-            
-            # 清理可能的 markdown 格式
-            json_text = re.sub(r'```json\s*', '', json_text)
-            json_text = re.sub(r'```\s*$', '', json_text)
-            json_text = json_text.strip()
-            
-            result = json.loads(json_text)
-            
-            validation_results = []
-            for issue in result.get('issues', []):
-                level = ValidationLevel.WARNING if issue['severity'] == 'low' else \
-                        ValidationLevel.ERROR if issue['severity'] in ['medium', 'high'] else \
-                        ValidationLevel.CRITICAL
-                
-                validation_results.append(ValidationResult(
-                    level=level,
-                    message=issue['description'],
-                    category=issue['type'],
-                    suggestion=issue['suggestion']
-                ))
-            
-            return validation_results
-            
+            fact_check_results = await fact_task
         except Exception as e:
             logging.error(f"事實一致性校驗失敗: {e}")
-            return [ValidationResult(
-                level=ValidationLevel.ERROR,
-                message=f"事實一致性校驗失敗: {str(e)}",
-                category="validation_error"
-            )]
+            fact_check_results = [self._section_error("事實一致性校驗失敗", e)]
+            section_errors.append('fact_consistency')
+        
+        # 事實一致性問題已足以讓分數歸零時，取消其餘仍在執行的 LLM 呼叫
+        if self._calculate_overall_score(fact_check_results, [], []) == 0:
+            highlight_task.cancel()
+            missing_task.cancel()
+            logging.info("事實一致性問題已使分數歸零，略過其餘驗證")
+            return self._with_section_errors({
+                'fact_consistency': fact_check_results,
+                'highlights': [],
+                'missing_alerts': [],
+                'anomalies': anomaly_results,
+                'overall_score': 0,
+                'short_circuit': True
+            }, section_errors)
+        
+        highlight_results, missing_alerts = await asyncio.gather(highlight_task, missing_task, return_exceptions=True)
+        if isinstance(highlight_results, Exception):
+            logging.error(f"關鍵資訊高亮失敗: {highlight_results}")
+            highlight_results = []
+            section_errors.append('highlights')
+        if isinstance(missing_alerts, Exception):
+            logging.error(f"遺漏資訊檢測失敗: {missing_alerts}")
+            missing_alerts = [self._section_error("遺漏資訊檢測失敗", missing_alerts)]
+            section_errors.append('missing_alerts')
+        
+        return self._with_section_errors({
+            'fact_consistency': fact_check_results,
+            'highlights': highlight_results,
+            'missing_alerts': missing_alerts,
+            'anomalies': anomaly_results,
+            'overall_score': self._calculate_overall_score(fact_check_results, missing_alerts, anomaly_results)
+        }, section_errors)
+
+    @staticmethod
+    def _with_section_errors(result: Dict[str, Any], section_errors: List[str]) -> Dict[str, Any]:
+        """有區段失敗時附上 degraded 與 section_errors 標記"""
+        if section_errors:
+            result['degraded'] = True
+            result['section_errors'] = section_errors
+        return result
+
+    def _build_unified_prompt(self, transcript: str, summary: str) -> str:
+        """建立合併提示：事實一致性、關鍵資訊、遺漏資訊與修改建議一次完成"""
+        return _PROMPT_TEMPLATES['unified'].format(transcript=transcript, summary=summary)
+
+    def _parse_unified_response(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """將合併提示的 JSON 回應分派到各區段的資料結構"""
+        fact_check_results = []
+        for issue in (payload.get('fact_consistency') or {}).get('issues', []):
+            level = ValidationLevel.WARNING if issue['severity'] == 'low' else \
+                    ValidationLevel.ERROR if issue['severity'] in ['medium', 'high'] else \
+                    ValidationLevel.CRITICAL
+            
+            fact_check_results.append(ValidationResult(
+                level=level,
+                message=issue['description'],
+                category=issue['type'],
+                suggestion=issue['suggestion']
+            ))
+        
+        highlights = []
+        for item in payload.get('highlights', []):
+            highlights.append(HighlightInfo(
+                text=item['text'],
+                start_pos=item['start_pos'],
+                end_pos=item['end_pos'],
+                category=item['category'],
+                confidence=item['confidence'],
+                importance=item['importance']
+            ))
+        
+        missing_alerts = []
+        for item in payload.get('missing_items', []):
+            level = ValidationLevel.WARNING if item['severity'] == 'low' else \
+                    ValidationLevel.ERROR if item['severity'] in ['medium', 'high'] else \
+                    ValidationLevel.CRITICAL
+            
+            missing_alerts.append(ValidationResult(
+                level=level,
+                message=f"可能遺漏: {item['description']}",
+                category=item['type'],
+                suggestion=item['suggestion']
+            ))
+        
+        modifications = [self._normalize_modification(mod) for mod in payload.get('modifications', [])]
+        
+        return {
+            'fact_consistency': fact_check_results,
+            'highlights': highlights,
+            'missing_alerts': missing_alerts,
+            'modifications': modifications
+        }
 
-    async def _extract_and_highlight_key_info(self, summary: str) -> List[HighlightInfo]:
-        """關鍵資訊高亮與驗證"""
-        prompt = f"""
-        作為醫療資訊專家，請從以下摘要中識別並標記關鍵醫療資訊：
-
-        摘要內容：
-        ---
-        {summary}
-        ---
-
-        請識別以下類型的關鍵資訊：
-        1. 生命徵象數值（血壓、心率、體溫、呼吸頻率等）
-        2. 實驗室檢查結果（血糖、膽固醇、血紅素等）
-        3. 藥物名稱和劑量
-        4. 重要症狀描述
-        5. 診斷結果
-        6. 治療建議
-
-        請以 JSON 格式回傳，使用繁體中文：
-        {{
-            "highlights": [
-                {{
-                    "text": "識別到的關鍵資訊",
-                    "start_pos": 起始位置,
-                    "end_pos": 結束位置,
-                    "category": "vital_signs|lab_values|medications|symptoms|diagnosis|treatment",
-                    "confidence": 0.0-1.0,
-                    "importance": "low|medium|high|critical"
-                }}
-            ]
-        }}
-        """
+    async def _unified_validation(self, transcript: str, summary: str) -> Dict[str, Any]:
+        """以單一 Gemini 請求取得所有 LLM 檢查結果"""
+        cache_key = _cache_key("unified_validation", transcript, summary)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            logging.info("合併驗證命中快取")
+            return cached
+        
+        gemini_model = self._get_gemini_model()
+        if not gemini_model:
+            raise ValueError("Gemini 模型未能成功載入")
+        response = await _gemini_with_retry(gemini_model, self._build_unified_prompt(transcript, summary))
+        
+        sections = self._parse_unified_response(_extract_json(response.text))
+        _cache_put(cache_key, sections)
+        return sections
 
-        try:
+    async def stream_validation(self, transcript: str, summary: str) -> AsyncIterator[Tuple[str, Any]]:
+        """串流驗證：合併提示回應中的每個區段一完成即產出 (區段名稱, 結果)
+        
+        依序產出 fact_consistency / highlights / missing_alerts / modifications（順序依模型輸出），
+        最後產出 anomalies 與 overall_score。
+        """
+        cache_key = _cache_key("unified_validation", transcript, summary)
+        sections = _cache_get(cache_key)
+        if sections is not None:
+            for section_name in _UNIFIED_SECTIONS.values():
+                yield section_name, sections[section_name]
+        else:
             gemini_model = self._get_gemini_model()
             if not gemini_model:
                 raise ValueError("Gemini 模型未能成功載入")
-            response = await gemini_model.generate_content_async(prompt)
-            
-            # 清理回應文字，提取 JSON 部分
-            response_text = response.text.strip()
-            
-            # 嘗試找到 JSON 部分
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            
-            if json_start != -1 and json_end > json_start:
-                json_text = response_text[json_start:json_end]
-            else:
-                json_text = response_text
-            
-            # 清理可能的 markdown 格式
-            json_text = re.sub(r'```json\s*', '', json_text)
-            json_text = re.sub(r'```\s*$', '', json_text)
-            json_text = json_text.strip()
-            
-            result = json.loads(json_text)
-            
-            highlights = []
-            for item in result.get('highlights', []):
-                highlights.append(HighlightInfo(
-                    text=item['text'],
-                    start_pos=item['start_pos'],
-                    end_pos=item['end_pos'],
-                    category=item['category'],
-                    confidence=item['confidence'],
-                    importance=item['importance']
-                ))
-            
-            return highlights
-            
-        except Exception as e:
-            logging.error(f"關鍵資訊高亮失敗: {e}")
-            return []
+            # 串流期間持有全行程共用的並行名額；首個片段逾時與配額熔斷由 start_gemini_stream 處理
+            async with get_gemini_semaphore():
+                response = await start_gemini_stream(gemini_model, self._build_unified_prompt(transcript, summary))
+            
+                buffer = ''
+                pos = -1
+                emitted = set()
+                async for chunk in response:
+                    buffer += chunk.text
+                    if pos == -1:
+                        object_start = buffer.find('{')
+                        if object_start == -1:
+                            continue
+                        pos = object_start + 1
+                    items, pos = _parse_completed_top_level_items(buffer, pos)
+                    for key, value in items:
+                        section_name = _UNIFIED_SECTIONS.get(key)
+                        if section_name is None or section_name in emitted:
+                            continue
+                        emitted.add(section_name)
+                        yield section_name, self._parse_unified_response({key: value})[section_name]
+            
+            # 以完整回應補齊尚未產出的區段，並寫入快取
+            sections = self._parse_unified_response(_extract_json(buffer))
+            _cache_put(cache_key, sections)
+            for section_name in _UNIFIED_SECTIONS.values():
+                if section_name not in emitted:
+                    yield section_name, sections[section_name]
+        
+        anomaly_results = await self._detect_anomalous_values(summary)
+        yield 'anomalies', anomaly_results
+        yield 'overall_score', self._calculate_overall_score(sections['fact_consistency'], sections['missing_alerts'], anomaly_results)
+
+    @staticmethod
+    def _section_error(message: str, error: Exception) -> ValidationResult:
+        """將單一檢查的例外轉為錯誤結果"""
+        return ValidationResult(
+            level=ValidationLevel.ERROR,
+            message=f"{message}: {str(error)}",
+            category="validation_error"
+        )
 
-    async def _detect_missing_information(self, transcript: str, summary: str) -> List[ValidationResult]:
-        """潛在遺漏提醒"""
-        prompt = f"""
-        作為醫療品質控制專家，請檢查摘要是否遺漏了重要資訊：
-
-        原始對話逐字稿：
-        ---
-        {transcript}
-        ---
-
-        生成的摘要：
-        ---
-        {summary}
-        ---
-
-        請檢查是否遺漏以下重要資訊，並詳細說明缺漏的具體內容：
-        1. 重要症狀描述（症狀的詳細描述、持續時間、嚴重程度等）
-        2. 關鍵生命徵象（血壓、心率、體溫、呼吸頻率、血氧飽和度等）
-        3. 藥物過敏史（過敏藥物名稱、過敏反應類型等）
-        4. 既往病史（過去疾病、手術史、慢性病等）
-        5. 家族病史（家族遺傳疾病、相關疾病史等）
-        6. 社會史（吸菸、飲酒、職業暴露、生活習慣等）
-
-        請以 JSON 格式回傳，使用繁體中文，並詳細說明缺漏的具體內容：
-        {{
-            "missing_items": [
-                {{
-                    "type": "symptom|vital_sign|allergy|medical_history|family_history|social_history",
-                    "severity": "low|medium|high|critical",
-                    "description": "詳細說明缺漏的具體資訊內容，例如：缺漏血壓數值、缺漏頭痛症狀的詳細描述等",
-                    "suggestion": "具體建議如何補充這些資訊，例如：請記錄收縮壓和舒張壓數值、請詳細描述頭痛的部位和性質等"
-                }}
-            ]
-        }}
-        """
+    async def _fact_consistency_check(self, transcript: str, summary: str) -> List[ValidationResult]:
+        """事實一致性校驗（已由合併提示取代，僅作為備用路徑）"""
+        prompt = _PROMPT_TEMPLATES['fact_consistency'].format(transcript=transcript, summary=summary)
+
+        cache_key = _cache_key("fact_consistency_check", transcript, summary)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        # 失敗時直接拋出，由呼叫端轉為錯誤結果並標記為降級
+        gemini_model = self._get_gemini_model()
+        if not gemini_model:
+            raise ValueError("Gemini 模型未能成功載入")
+        response = await _gemini_with_retry(gemini_model, prompt)
+        
+        result = _extract_json(response.text)
+        
+        validation_results = []
+        for issue in result.get('issues', []):
+            level = ValidationLevel.WARNING if issue['severity'] == 'low' else \
+                    ValidationLevel.ERROR if issue['severity'] in ['medium', 'high'] else \
+                    ValidationLevel.CRITICAL
+            
+            validation_results.append(ValidationResult(
+                level=level,
+                message=issue['description'],
+                category=issue['type'],
+                suggestion=issue['suggestion']
+            ))
+        
+        _cache_put(cache_key, validation_results)
+        return validation_results
 
-        try:
-            gemini_model = self._get_gemini_model()
-            if not gemini_model:
-                raise ValueError("Gemini 模型未能成功載入")
-            response = await gemini_model.generate_content_async(prompt)
-            
-            # 清理回應文字，提取 JSON 部分
-            response_text = response.text.strip()
-            
-            # 嘗試找到 JSON 部分
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            
-            if json_start != -1 and json_end > json_start:
-                json_text = response_text[json_start:json_end]
-            else:
-                json_text = response_text
-            
-            # 清理可能的 markdown 格式
-            json_text = re.sub(r'```json\s*', '', json_text)
-            json_text = re.sub(r'```\s*$', '', json_text)
-            json_text = json_text.strip()
-            
-            result = json.loads(json_text)
-            
-            missing_alerts = []
-            for item in result.get('missing_items', []):
-                level = ValidationLevel.WARNING if item['severity'] == 'low' else \
-                        ValidationLevel.ERROR if item['severity'] in ['medium', 'high'] else \
-                        ValidationLevel.CRITICAL
-                
-                missing_alerts.append(ValidationResult(
-                    level=level,
-                    message=f"可能遺漏: {item['description']}",
-                    category=item['type'],
-                    suggestion=item['suggestion']
-                ))
-            
-            return missing_alerts
-            
-        except Exception as e:
-            logging.error(f"遺漏資訊檢測失敗: {e}")
-            return []
+    async def _extract_and_highlight_key_info(self, summary: str) -> List[HighlightInfo]:
+        """關鍵資訊高亮與驗證（已由合併提示取代，僅作為備用路徑）"""
+        prompt = _PROMPT_TEMPLATES['highlights'].format(summary=summary)
+
+        cache_key = _cache_key("extract_and_highlight_key_info", summary)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        gemini_model = self._get_gemini_fast_model()
+        if not gemini_model:
+            raise ValueError("Gemini 模型未能成功載入")
+        response = await _gemini_with_retry(gemini_model, prompt)
+        
+        result = _extract_json(response.text)
+        
+        highlights = []
+        for item in result.get('highlights', []):
+            highlights.append(HighlightInfo(
+                text=item['text'],
+                start_pos=item['start_pos'],
+                end_pos=item['end_pos'],
+                category=item['category'],
+                confidence=item['confidence'],
+                importance=item['importance']
+            ))
+        
+        _cache_put(cache_key, highlights)
+        return highlights
 
-    async def _detect_anomalous_values(self, summary: str) -> List[AnomalyDetection]:
-        """異常數值標記"""
-        # 使用正則表達式提取數值
-        value_patterns = {
-            'blood_pressure': r'血壓[：:]?\s*(\d+)/(\d+)',
-            'heart_rate': r'心率[：:]?\s*(\d+)',
-            'temperature': r'體溫[：:]?\s*(\d+\.?\d*)',
-            'blood_sugar': r'血糖[：:]?\s*(\d+\.?\d*)'
-        }
+    async def _detect_missing_information(self, transcript: str, summary: str) -> List[ValidationResult]:
+        """潛在遺漏提醒（已由合併提示取代，僅作為備用路徑）"""
+        prompt = _PROMPT_TEMPLATES['missing_information'].format(transcript=transcript, summary=summary)
+
+        cache_key = _cache_key("detect_missing_information", transcript, summary)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        gemini_model = self._get_gemini_fast_model(transcript)
+        if not gemini_model:
+            raise ValueError("Gemini 模型未能成功載入")
+        response = await _gemini_with_retry(gemini_model, prompt)
         
-        anomalies = []
+        result = _extract_json(response.text)
         
-        for vital_type, pattern in value_patterns.items():
-            matches = re.finditer(pattern, summary)
-            for match in matches:
-                if vital_type == 'blood_pressure':
-                    systolic, diastolic = int(match.group(1)), int(match.group(2))
-                    if not (self.critical_values['blood_pressure']['normal'][0] <= systolic <= self.critical_values['blood_pressure']['normal'][1]):
-                        anomalies.append(AnomalyDetection(
-                            value=f"{systolic}/{diastolic}",
-                            normal_range="90-140/60-90",
-                            severity="high" if systolic > 180 or systolic < 60 else "medium",
-                            suggestion="請確認血壓數值是否正確",
-                            position=(match.start(), match.end())
-                        ))
-                elif vital_type == 'heart_rate':
-                    hr = int(match.group(1))
-                    if not (self.critical_values['heart_rate']['normal'][0] <= hr <= self.critical_values['heart_rate']['normal'][1]):
-                        anomalies.append(AnomalyDetection(
-                            value=str(hr),
-                            normal_range="60-100",
-                            severity="high" if hr > 150 or hr < 40 else "medium",
-                            suggestion="請確認心率數值是否正確",
-                            position=(match.start(), match.end())
-                        ))
-                elif vital_type == 'temperature':
-                    temp = float(match.group(1))
-                    if not (self.critical_values['temperature']['normal'][0] <= temp <= self.critical_values['temperature']['normal'][1]):
-                        anomalies.append(AnomalyDetection(
-                            value=str(temp),
-                            normal_range="36.0-37.5°C",
-                            severity="high" if temp > 40 or temp < 35 else "medium",
-                            suggestion="請確認體溫數值是否正確",
-                            position=(match.start(), match.end())
-                        ))
-                elif vital_type == 'blood_sugar':
-                    bs = float(match.group(1))
-                    if not (self.critical_values['blood_sugar']['normal'][0] <= bs <= self.critical_values['blood_sugar']['normal'][1]):
-                        anomalies.append(AnomalyDetection(
-                            value=str(bs),
-                            normal_range="70-140 mg/dL",
-                            severity="high" if bs > 300 or bs < 50 else "medium",
-                            suggestion="請確認血糖數值是否正確",
-                            position=(match.start(), match.end())
-                        ))
+        missing_alerts = []
+        for item in result.get('missing_items', []):
+            level = ValidationLevel.WARNING if item['severity'] == 'low' else \
+                    ValidationLevel.ERROR if item['severity'] in ['medium', 'high'] else \
+                    ValidationLevel.CRITICAL
+            
+            missing_alerts.append(ValidationResult(
+                level=level,
+                message=f"可能遺漏: {item['description']}",
+                category=item['type'],
+                suggestion=item['suggestion']
+            ))
         
+        _cache_put(cache_key, missing_alerts)
+        return missing_alerts
+
+    async def _detect_anomalous_values(self, summary: str) -> List[AnomalyDetection]:
+        """異常數值標記"""
+        return self._scan_vitals(summary)
+
+    def _scan_vitals(self, summary: str) -> List[AnomalyDetection]:
+        """單次掃描摘要，依命中的群組分派到對應檢查；僅為超出正常範圍的數值建立結果物件"""
+        checks = self.VITAL_CHECKS
+        anomalies = []
+        for match in _COMBINED_VITALS.finditer(summary):
+            checks[match.lastgroup](match, anomalies)
         return anomalies
 
     def _calculate_overall_score(self, fact_check: List[ValidationResult], 
@@ -435,8 +750,22 @@ class MedicalSummaryValidator:
             # 1. 先進行驗證分析
             validation_result = await self.validate_summary(transcript, summary)
             
-            # 2. 基於驗證結果生成修改建議
-            modifications = await self._generate_modifications(transcript, summary, validation_result)
+            # 2. 合併提示已附帶修改建議時直接使用（空清單代表無需修改），僅逐項驗證路徑才另外生成
+            degraded = bool(validation_result.get('degraded'))
+            modifications = validation_result.pop('modifications', None)
+            if modifications is not None:
+                modifications = modifications[:10]
+            elif validation_result.get('short_circuit'):
+                # 分數已歸零，不再額外呼叫 LLM，僅使用規則式錯誤檢測
+                modifications = self._generate_error_detection(transcript, summary, validation_result)[:10]
+            else:
+                try:
+                    modifications = await self._generate_modifications(transcript, summary, validation_result)
+                except Exception as e:
+                    logging.error(f"AI 修改建議生成失敗: {e}")
+                    # 回退到基於規則的建議；結果不完整，標記為降級
+                    modifications = self._generate_fallback_modifications(transcript, summary, validation_result)
+                    degraded = True
             
             # 3. 生成後端保證的安全修改版本（只做句內替換，不動 Markdown 結構與換行）
             patched_summary = self._apply_inline_replacements_preserving_structure(summary, modifications)
@@ -452,7 +781,8 @@ class MedicalSummaryValidator:
                 'original_summary': summary,
                 'patched_summary': patched_summary,
                 'modifications': modifications,
-                'validation_result': validation_result
+                'validation_result': validation_result,
+                'degraded': degraded
             }
             
         except Exception as e:
@@ -468,110 +798,44 @@ class MedicalSummaryValidator:
         logging.info(f"摘要前 200 字符: {summary[:200]}...")
         
         # 專注於檢測幻覺和不一致之處
-        prompt = f"""
-        作為醫療摘要審核專家，請仔細比較逐字稿和摘要，檢測任何不一致之處。
-
-        逐字稿：
-        {transcript}
-
-        當前摘要（請注意保持 Markdown 格式）：
-        {summary}
-
-        請積極檢查以下問題，即使是很小的差異也要報告：
-
-        1. **用詞差異**：摘要中的用詞是否與逐字稿完全一致？例如：「幾個月」vs「過去幾個月」
-        2. **細節差異**：摘要是否遺漏了逐字稿中的重要細節？
-        3. **表達方式**：摘要的表達是否與逐字稿的語氣和風格一致？
-        4. **事實不一致**：摘要中的資訊是否與逐字稿不符？
-        5. **數值錯誤**：摘要中的數值是否與逐字稿中的數值一致？
-        6. **時間錯誤**：摘要中的時間描述是否正確？
-
-        請以 JSON 格式回傳檢測結果，使用繁體中文：
-        {{
-            "modifications": [
-                {{
-                    "type": "replace|highlight|remove",
-                    "title": "錯誤標題",
-                    "description": "發現的具體錯誤",
-                    "original_text": "摘要中需要修改的具體文字",
-                    "correct_text": "應該替換成的正確文字",
-                    "reason": "為什麼這是錯誤的",
-                    "severity": "critical|high|medium|low",
-                    "category": "hallucination|fact_error|value_error|time_error|diagnosis_error|treatment_error"
-                }}
-            ]
-        }}
-
-        ⚠️ 重要警告：你絕對不能破壞 Markdown 格式！⚠️
-
-        重要要求：
-        1. **絕對嚴禁更動 Markdown 結構**：不得修改標題格式（## 看診重點摘要）、粗體標題（**看診原因**、**診斷結果**等）、換行與空行。
-        2. **僅允許句內最小範圍替換**：不得把多行合併成一行，不得修改段落結構。
-        3. original_text 必須是摘要中實際存在的文字，且不包含換行字元。
-        4. correct_text 必須是基於逐字稿的正確內容，且不包含換行字元。
-        5. 如果檢測到幻覺內容，使用 remove 類型；若為事實錯誤，使用 replace 類型。
-        6. 請同時提供該 original_text 在摘要中的字元位置：start（含）與 end（不含）。
-        7. **請積極檢測錯誤**：即使是很小的用詞差異也要報告，不要過於保守。
-        8. **保持完整格式**：修改後的摘要必須保持原始的 Markdown 格式，包括標題、粗體、段落分隔。
-        9. **格式範例**：正確的格式應該是「## 看診重點摘要」而不是「看診重點摘要」，應該是「**看診原因**」而不是「看診原因」。
-        10. **如果沒有發現錯誤，請回傳空的 modifications 陣列**：{{"modifications": []}}
-
-        🚨 特別提醒：如果你破壞了 Markdown 格式（例如把「## 看診重點摘要」改成「看診重點摘要」），這將被視為嚴重錯誤！
-        """
+        prompt = _PROMPT_TEMPLATES['modifications'].format(transcript=transcript, summary=summary)
 
-        try:
-            gemini_model = self._get_gemini_model()
-            if not gemini_model:
-                raise ValueError("Gemini 模型未能成功載入")
-            
-            response = await gemini_model.generate_content_async(prompt)
-            
-            # 清理回應文字，提取 JSON 部分
-            response_text = response.text.strip()
-            
-            # 嘗試找到 JSON 部分
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            
-            if json_start != -1 and json_end > json_start:
-                json_text = response_text[json_start:json_end]
-            else:
-                json_text = response_text
-            
-            # 清理可能的 markdown 格式
-            json_text = re.sub(r'```json\s*', '', json_text)
-            json_text = re.sub(r'```\s*$', '', json_text)
-            json_text = json_text.strip()
-            
-            result = json.loads(json_text)
-            
-            # 處理 AI 生成的錯誤檢測結果
-            for mod in result.get('modifications', []):
-                modifications.append({
-                    'type': mod.get('type', 'highlight'),
-                    'title': mod.get('title', '錯誤檢測'),
-                    'description': mod.get('description', ''),
-                    'original_text': mod.get('original_text', ''),
-                    'correct_text': mod.get('correct_text', ''),
-                    'reason': mod.get('reason', ''),
-                    'severity': mod.get('severity', 'medium'),
-                    'category': mod.get('category', 'fact_error'),
-                    # 可選的精確位置，如果模型有提供
-                    'start': mod.get('start'),
-                    'end': mod.get('end'),
-                })
-            
-            # 如果 AI 沒有檢測到錯誤，添加基於驗證結果的錯誤檢測
-            if len(modifications) == 0:
-                modifications.extend(self._generate_error_detection(transcript, summary, validation_result))
-            
-            return modifications[:10]  # 限制最多10個建議
-            
-        except Exception as e:
-            logging.error(f"AI 修改建議生成失敗: {e}")
-            # 回退到基於規則的建議
-            return self._generate_fallback_modifications(transcript, summary, validation_result)
+        # 失敗時直接拋出，由 smart_modify_summary 回退到規則式建議並標記為降級
+        gemini_model = self._get_gemini_model()
+        if not gemini_model:
+            raise ValueError("Gemini 模型未能成功載入")
+        
+        response = await _gemini_with_retry(gemini_model, prompt)
+        
+        result = _extract_json(response.text)
+        
+        # 處理 AI 生成的錯誤檢測結果
+        for mod in result.get('modifications', []):
+            modifications.append(self._normalize_modification(mod))
+        
+        # 如果 AI 沒有檢測到錯誤，添加基於驗證結果的錯誤檢測
+        if len(modifications) == 0:
+            modifications.extend(self._generate_error_detection(transcript, summary, validation_result))
+        
+        return modifications[:10]  # 限制最多10個建議
     
+    @staticmethod
+    def _normalize_modification(mod: Dict[str, Any]) -> Dict[str, Any]:
+        """補齊 AI 回傳修改建議的預設欄位"""
+        return {
+            'type': mod.get('type', 'highlight'),
+            'title': mod.get('title', '錯誤檢測'),
+            'description': mod.get('description', ''),
+            'original_text': mod.get('original_text', ''),
+            'correct_text': mod.get('correct_text', ''),
+            'reason': mod.get('reason', ''),
+            'severity': mod.get('severity', 'medium'),
+            'category': mod.get('category', 'fact_error'),
+            # 可選的精確位置，如果模型有提供
+            'start': mod.get('start'),
+            'end': mod.get('end'),
+        }
+
     def _generate_error_detection(self, transcript: str, summary: str, validation_result: Dict[str, Any]) -> List[Dict[str, Any]]:
         """生成錯誤檢測建議 - 專注於檢測幻覺和不一致"""
         modifications = []
@@ -605,26 +869,30 @@ class MedicalSummaryValidator:
                 })
         
         # 檢測摘要中可能存在的幻覺（逐字稿中沒有的內容）
-        transcript_lower = transcript.lower()
-        summary_sentences = summary.split('。')
+        # 關鍵詞皆為中文，無需轉小寫；先以逐字稿的 2-gram 集合預篩，
+        # 只有預篩判定「可能出現」時才做精確子字串比對以排除誤判
+        transcript_shingles = _shingles(transcript)
+        absent_terms = [
+            term for term in HALLUCINATION_KEY_TERMS
+            if not _TERM_SHINGLES[term].issubset(transcript_shingles) or term not in transcript
+        ]
+        summary_sentences = _split_sentences(summary) if absent_terms else ()
         
         for sentence in summary_sentences:
-            if sentence.strip():
-                # 檢查句子中的關鍵詞是否在逐字稿中出現
-                key_terms = ['診斷', '治療', '藥物', '手術', '檢查']
-                for term in key_terms:
-                    if term in sentence and term not in transcript_lower:
-                        modifications.append({
-                            'type': 'highlight',
-                            'title': '可能的幻覺內容',
-                            'description': f'摘要中提到「{term}」但逐字稿中未提及',
-                            'original_text': sentence,
-                            'correct_text': '請確認此內容是否在逐字稿中出現',
-                            'reason': '摘要中的內容在逐字稿中找不到對應',
-                            'severity': 'high',
-                            'category': 'hallucination'
-                        })
-                        break
+            # 檢查句子中是否提到逐字稿未出現的關鍵詞
+            for term in absent_terms:
+                if term in sentence:
+                    modifications.append({
+                        'type': 'highlight',
+                        'title': '可能的幻覺內容',
+                        'description': f'摘要中提到「{term}」但逐字稿中未提及',
+                        'original_text': sentence,
+                        'correct_text': '請確認此內容是否在逐字稿中出現',
+                        'reason': '摘要中的內容在逐字稿中找不到對應',
+                        'severity': 'high',
+                        'category': 'hallucination'
+                    })
+                    break
         
         return modifications
 
@@ -652,15 +920,14 @@ class MedicalSummaryValidator:
             if stripped.startswith('##') or stripped.startswith('#') or stripped.startswith('**'):
                 protected_line_indexes.add(idx)
 
+        # 每行結束位置的前綴和，用二分搜尋將全局位置映射到行索引
+        line_ends = list(itertools.accumulate(len(line) for line in lines))
+
         def position_in_protected_line(start: int, end: int) -> bool:
-            # 將全局位置映射到行索引
-            pos = 0
-            for i, line in enumerate(lines):
-                next_pos = pos + len(line)
-                if start < next_pos and end <= next_pos:
-                    return i in protected_line_indexes
-                pos = next_pos
-            return False
+            # 第一個同時滿足 start < 行尾 與 end <= 行尾 的行
+            i = bisect.bisect_right(line_ends, start)
+            j = bisect.bisect_left(line_ends, end)
+            return max(i, j) in protected_line_indexes
 
         # 逐項套用替換，從後往前避免位移影響
         # 先蒐集可用的替換區段
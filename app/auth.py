@@ -1,5 +1,9 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
@@ -9,21 +13,20 @@ from passlib.context import CryptContext
 from sqlalchemy.orm import Session
 
 from .config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
-from .database import SessionLocal
+from .database import get_db  # 供路由以 from ..auth import get_db 取用，與 database.get_db 為同一個依賴
 from .models import UserDB
-from .schemas import TokenData
+from .schemas import TokenData, User
 
 
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# 已驗證 token 的解碼結果快取：鍵為 token 的 16 位元組 BLAKE2b 摘要，值為 (username, role, 快取到期時間)。
+# 到期時間取 TTL 與 token exp 的較早者，因此過期 token 不會因快取而被接受
+JWT_CACHE_MAX_ENTRIES = 10000
+JWT_CACHE_TTL_SECONDS = 30
+_jwt_cache: "OrderedDict[bytes, Tuple[str, str, float]]" = OrderedDict()
+_jwt_cache_lock = threading.Lock()
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -41,22 +44,50 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(status_code=401, detail="無法驗證憑證", headers={"WWW-Authenticate": "Bearer"})
+def _decode_token_cached(token: str) -> Optional[Tuple[str, str]]:
+    """解碼並驗證 token，回傳 (username, role)；無效時回傳 None。短時間內重複的 token 直接命中快取"""
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    now = time.time()
+    with _jwt_cache_lock:
+        entry = _jwt_cache.get(key)
+        if entry is not None:
+            if entry[2] > now:
+                _jwt_cache.move_to_end(key)
+                return entry[0], entry[1]
+            del _jwt_cache[key]
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        role: str = payload.get("role", "Doctor")
-        if username is None:
-            raise credentials_exception
-        # 返回簡化的用戶對象
-        from .schemas import User
-        from datetime import datetime
-        return User(id=1, username=username, role=role, created_at=datetime.now())
     except PyJWTError:
-        raise credentials_exception
-
-
-
+        return None
+    username = payload.get("sub")
+    if username is None:
+        return None
+    role = payload.get("role", "Doctor")
+
+    expires_at = now + JWT_CACHE_TTL_SECONDS
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        expires_at = min(expires_at, exp)
+    with _jwt_cache_lock:
+        _jwt_cache[key] = (username, role, expires_at)
+        _jwt_cache.move_to_end(key)
+        while len(_jwt_cache) > JWT_CACHE_MAX_ENTRIES:
+            _jwt_cache.popitem(last=False)
+    return username, role
 
 
+def get_current_user(token: str = Depends(oauth2_scheme)):
+    decoded = _decode_token_cached(token)
+    if decoded is None:
+        raise HTTPException(status_code=401, detail="無法驗證憑證", headers={"WWW-Authenticate": "Bearer"})
+    username, role = decoded
+    # 返回簡化的用戶對象
+    return User(id=1, username=username, role=role, created_at=datetime.now())
+
+
+async def require_doctor(current_user: User = Depends(get_current_user)) -> User:
+    """限醫師存取的路由共用的角色檢查（async 以免額外佔用執行緒池）"""
+    if current_user.role != "Doctor":
+        raise HTTPException(status_code=403, detail="權限不足，僅限醫生操作")
+    return current_user
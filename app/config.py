@@ -21,9 +21,27 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# 全行程共用的 Gemini 同時請求上限（摘要、SOAP、標籤與驗證共用同一配額）
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "5"))
+
+# AI 模式：設為 "regex_only" 時不載入 Gemini SDK（僅提供規則式檢查）
+AI_MODE = os.getenv("AI_MODE", "")
+
 # Database URL (may be overridden to sqlite later)
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
+# Database connection pool
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# 連線經由 PgBouncer 等交易層級連線池時設為 1：停用 pre-ping，改以短週期 recycle
+DB_BEHIND_POOLER = os.getenv("DB_BEHIND_POOLER", "0") == "1"
+DB_POOLER_RECYCLE = int(os.getenv("DB_POOLER_RECYCLE", "60"))
+
+# 同步資料庫處理函式所使用的執行緒池大小，預設與連線池上限一致
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+
 # CORS origins
 ORIGINS = [
     "http://localhost",
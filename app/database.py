@@ -1,8 +1,36 @@
 import logging
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool
 
-from .config import DATABASE_URL
+from .config import (
+    DATABASE_URL,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_BEHIND_POOLER,
+    DB_POOLER_RECYCLE,
+)
+
+# SQLite 連線層級設定：WAL 讓大量讀取的端點不必等待偶發的寫入，busy_timeout 讓寫入衝突時等待而非立即失敗
+SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("temp_store", "MEMORY"),
+    ("mmap_size", "268435456"),
+    ("cache_size", "-64000"),
+    ("busy_timeout", "5000"),
+)
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
 
 
 def create_engine_from_url() -> "Engine":
@@ -14,10 +42,25 @@ def create_engine_from_url() -> "Engine":
         elif db_url.startswith("postgres://"):
             db_url = db_url.replace("postgres://", "postgresql+psycopg://", 1)
 
+        # PgBouncer 交易模式下 pre-ping 的 SELECT 1 會造成額外往返與閒置交易，改以 recycle 淘汰舊連線
+        behind_pooler = DB_BEHIND_POOLER or "pgbouncer" in db_url
+        if behind_pooler:
+            logging.info("偵測到連線池中介層，停用 pool_pre_ping。")
+
         logging.info("偵測到 PostgreSQL DATABASE_URL，正在建立連線引擎...")
         try:
-            engine = create_engine(db_url, pool_pre_ping=True)
-            with engine.connect() as _:
+            engine = create_engine(
+                db_url,
+                poolclass=QueuePool,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_timeout=DB_POOL_TIMEOUT,
+                pool_recycle=DB_POOLER_RECYCLE if behind_pooler else DB_POOL_RECYCLE,
+                pool_pre_ping=not behind_pooler,
+            )
+            with engine.connect() as conn:
+                # 明確結束測試連線的交易，避免第一條池化連線停留在 idle in transaction
+                conn.rollback()
                 logging.info("PostgreSQL 資料庫連線測試成功。")
         except Exception as e:
             logging.error(f"PostgreSQL 連線失敗: {e}")
@@ -27,7 +70,16 @@ def create_engine_from_url() -> "Engine":
     if engine is None:
         logging.info("使用本地 SQLite 資料庫...")
         db_url = "sqlite:///./medical_system_final_v2.db"
-        engine = create_engine(db_url, connect_args={"check_same_thread": False})
+        # 連線池大小與執行緒池一致（SQLAlchemy 對檔案型 SQLite 預設僅 5+10），WAL 下多條讀取連線可同時作業
+        engine = create_engine(
+            db_url,
+            connect_args={"check_same_thread": False},
+            poolclass=QueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+        event.listen(engine, "connect", _apply_sqlite_pragmas)
 
     return engine
 
@@ -37,6 +89,13 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+def create_missing_indexes() -> None:
+    """為既有資料表補建模型中新增的索引（create_all 只會建立不存在的資料表）"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -1,6 +1,6 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Text, DateTime
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Text, DateTime, Index
+from sqlalchemy.orm import relationship
 
 from .database import Base
 
@@ -20,7 +20,7 @@ class PatientDB(Base):
     name = Column(String, index=True)
     birthDate = Column(String)
     gender = Column(String)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     appointments = relationship("AppointmentDB", back_populates="patient", cascade="all, delete-orphan")
@@ -33,13 +33,20 @@ class DoctorDB(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
     specialty = Column(String)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    appointments = relationship("AppointmentDB", back_populates="doctor", cascade="all, delete-orphan")
 
 
 class AppointmentDB(Base):
     __tablename__ = "appointments"
+    __table_args__ = (
+        # 儀表板「下一次看診」：patient_id 等值 + appointment_date 範圍與排序
+        Index("ix_appt_patient_date", "patient_id", "appointment_date"),
+        # 醫生的病患列表：doctor_id 等值 + DISTINCT patient_id，可由索引直接取得而不回表
+        Index("ix_appt_doctor_patient", "doctor_id", "patient_id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     appointment_date = Column(String)
     reason = Column(String)
@@ -51,13 +58,18 @@ class AppointmentDB(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     patient = relationship("PatientDB", back_populates="appointments")
-    doctor = relationship("DoctorDB", backref=backref("appointments", cascade="all, delete-orphan"))
+    doctor = relationship("DoctorDB", back_populates="appointments")
+    # 不在模型層預設 selectin：需要任務的查詢自行 selectinload，其餘查詢不再附帶一次任務 SELECT
     tasks = relationship("TaskDB", back_populates="appointment", cascade="all, delete-orphan")
     prescriptions = relationship("PrescriptionDB", back_populates="appointment", cascade="all, delete-orphan")
 
 
 class TaskDB(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        # 儀表板待辦任務：patient_id + is_completed
+        Index("ix_task_patient_open", "patient_id", "is_completed"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     description = Column(String)
     due_date = Column(String)
@@ -71,6 +83,10 @@ class TaskDB(Base):
 
 class PrescriptionDB(Base):
     __tablename__ = "prescriptions"
+    __table_args__ = (
+        # 病患處方列表：patient_id 等值 + created_at 排序
+        Index("ix_prescription_patient_created", "patient_id", "created_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     medication_name = Column(String)
     medication_code = Column(String, nullable=True, index=True)
@@ -78,7 +94,8 @@ class PrescriptionDB(Base):
     frequency = Column(String)
     prescribed_on = Column(String)
     patient_id = Column(Integer, ForeignKey("patients.id"))
-    doctor_id = Column(Integer, ForeignKey("doctors.id"))
+    # PostgreSQL 不會自動為外鍵建索引；刪除醫生時的參照檢查需要此索引避免全表掃描
+    doctor_id = Column(Integer, ForeignKey("doctors.id"), index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     patient = relationship("PatientDB", back_populates="prescriptions")
     appointment_id = Column(Integer, ForeignKey("appointments.id"), nullable=True, index=True)
@@ -1,14 +1,27 @@
 import asyncio
+import json
 import logging
-import os
-import shutil
-import tempfile
+import re
+from typing import Dict, List
 
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
+from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
 
-from ..ai import get_openai_client
-from ..ai import gemini_model
+from ..ai import (
+    call_gemini_with_retry,
+    get_gemini_model,
+    get_openai_client,
+    stream_generate,
+    submit_gemini_batch,
+    wait_gemini_batch,
+)
+from ..database import SessionLocal, get_db
+from ..models import AppointmentDB, DoctorDB
 from ..utils.markdown_utils import normalize_summary_markdown
+from ..utils.sse_utils import SSE_HEADERS, format_sse_event, make_sse_field_formatter
 from ..auth import get_current_user
 from ..schemas import TranscriptData, User
 from pydantic import BaseModel
@@ -18,26 +31,19 @@ class SoapSummaryRequest(BaseModel):
     transcript: str
 
 
-router = APIRouter(tags=["AI"])
+class BatchSummaryItem(BaseModel):
+    appointment_id: int
+    transcript: str
 
 
-@router.post("/summarize")
-async def summarize_text(transcript_data: TranscriptData, current_user: User = Depends(get_current_user)):
-    if current_user.role != "Doctor":
-        raise HTTPException(status_code=403, detail="權限不足")
-    
-    # 重新導入模型以確保最新狀態
-    from ..ai import gemini_model as current_gemini_model
-    
-    logging.info(f"Gemini 模型狀態: {current_gemini_model is not None}")
-    logging.info(f"Gemini 模型類型: {type(current_gemini_model)}")
-    if current_gemini_model:
-        logging.info(f"Gemini 模型名稱: {getattr(current_gemini_model, 'model_name', 'Unknown')}")
-    
-    if not current_gemini_model:
-        raise HTTPException(status_code=500, detail="Gemini 模型未能成功載入，請檢查伺服器日誌。")
+class BatchSummaryRequest(BaseModel):
+    items: List[BatchSummaryItem]
 
-    prompt = f"""
+
+router = APIRouter(tags=["AI"])
+
+# 提示模板於模組載入時建立，每次請求僅需串接逐字稿
+_SUMMARY_PROMPT_HEAD = """
     角色：你是一位有耐心、善於溝通的家庭醫師或衛教護理師。你的專長是將複雜的醫療資訊，用溫暖、簡單易懂的語言解釋給病患聽。
 
     任務：請將以下的「醫病對話逐字稿」，轉換成一份給病患本人看的「看診重點摘要」。這份摘要的目的是幫助病患回家後，能清楚回顧看診內容、了解自己的狀況並遵循醫囑。
@@ -75,35 +81,95 @@ async def summarize_text(transcript_data: TranscriptData, current_user: User = D
 
     醫病對話逐字稿：
     ---
-    {transcript_data.text}
+    """
+_SUMMARY_PROMPT_TAIL = """
     ---
 
     請嚴格按照上述格式生成摘要，開始：
     """
 
+_SOAP_PROMPT_HEAD = """
+    角色：你是一位專業的醫療記錄專家，專門將醫病對話逐字稿轉換成標準的 SOAP 格式醫療記錄。
+
+    任務：請將以下的「醫病對話逐字稿」，轉換成標準的 SOAP 格式醫療記錄。
+
+    SOAP 格式說明：
+    - S (Subjective): 主觀症狀 - 病患描述的主訴、症狀、感受
+    - O (Objective): 客觀發現 - 醫師觀察到的客觀事實、檢查結果、生命徵象
+    - A (Assessment): 評估 - 醫師的診斷、判斷、分析
+    - P (Plan): 計畫 - 治療計畫、用藥、追蹤、衛教
+
+    重要規則：
+    1. 嚴格按照 SOAP 格式分類資訊
+    2. 使用專業但簡潔的醫療術語
+    3. 內容必須基於逐字稿，不可添加額外資訊
+    4. 使用繁體中文
+    5. 每個部分都要有具體內容，如果某部分沒有資訊則標註「無」
+
+    醫病對話逐字稿：
+    ---
+    """
+_SOAP_PROMPT_TAIL = """
+    ---
+
+    請按照以下 JSON 格式回傳 SOAP 摘要：
+    {
+        "subjective": "主觀症狀內容",
+        "objective": "客觀發現內容", 
+        "assessment": "評估內容",
+        "plan": "計畫內容"
+    }
+    """
+
+# 清除 Gemini 回應中的 markdown 程式碼區塊標記
+_JSON_FENCE = re.compile(r'```json\s*')
+_TAIL_FENCE = re.compile(r'```\s*$')
+
+# 非 JSON 回應時的 SOAP 段落關鍵字，合併為單一交替式 regex
+_SOAP_SECTION_RE = re.compile(
+    r'(?P<subjective>subjective|主觀|s:|症狀)'
+    r'|(?P<objective>objective|客觀|o:|發現)'
+    r'|(?P<assessment>assessment|評估|a:|診斷)'
+    r'|(?P<plan>plan|計畫|p:|治療)',
+    re.IGNORECASE,
+)
+_SOAP_DEFAULTS = {
+    "subjective": "無主觀症狀描述",
+    "objective": "無客觀發現",
+    "assessment": "無評估結果",
+    "plan": "無治療計畫",
+}
+
+# 批次摘要單次可送出的看診數上限
+SUMMARY_BATCH_MAX_ITEMS = 200
+
+# 串流端點中每個片段都會送出的高頻事件：固定前後綴預先組好，每次只編碼變動的值
+_format_chunk_event = make_sse_field_formatter('chunk', 'text')
+_format_progress_event = make_sse_field_formatter('progress', 'received_chars')
+
+
+@router.post("/summarize")
+async def summarize_text(transcript_data: TranscriptData, current_user: User = Depends(get_current_user)):
+    if current_user.role != "Doctor":
+        raise HTTPException(status_code=403, detail="權限不足")
+    
+    current_gemini_model = get_gemini_model()
+    
+    logging.info(f"Gemini 模型狀態: {current_gemini_model is not None}")
+    logging.info(f"Gemini 模型類型: {type(current_gemini_model)}")
+    if current_gemini_model:
+        logging.info(f"Gemini 模型名稱: {getattr(current_gemini_model, 'model_name', 'Unknown')}")
+    
+    if not current_gemini_model:
+        raise HTTPException(status_code=500, detail="Gemini 模型未能成功載入，請檢查伺服器日誌。")
+
+    prompt = _SUMMARY_PROMPT_HEAD + transcript_data.text + _SUMMARY_PROMPT_TAIL
+
     try:
-        # 添加重試機制
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                response = await current_gemini_model.generate_content_async(prompt)
-                summary_text = normalize_summary_markdown(response.text)
-                logging.info(f"Gemini summary generated for user {current_user.username}")
-                return {"summary": summary_text.strip()}
-            except Exception as e:
-                error_msg = str(e)
-                if "quota" in error_msg.lower() or "429" in error_msg:
-                    if attempt < max_retries - 1:
-                        wait_time = (attempt + 1) * 10  # 遞增等待時間
-                        logging.warning(f"API 配額限制，等待 {wait_time} 秒後重試 (嘗試 {attempt + 1}/{max_retries})")
-                        await asyncio.sleep(wait_time)
-                        continue
-                    else:
-                        logging.error(f"API 配額已用完，無法生成摘要: {e}")
-                        raise HTTPException(status_code=429, detail="AI 服務配額已用完，請稍後再試")
-                else:
-                    raise e
-        raise HTTPException(status_code=500, detail=f"生成摘要失敗: {e}")
+        response_text = await call_gemini_with_retry(current_gemini_model, prompt, "summary")
+        summary_text = normalize_summary_markdown(response_text)
+        logging.info(f"Gemini summary generated for user {current_user.username}")
+        return {"summary": summary_text.strip()}
     except HTTPException:
         raise
     except Exception as e:
@@ -113,24 +179,20 @@ async def summarize_text(transcript_data: TranscriptData, current_user: User = D
 
 @router.post("/transcribe")
 async def transcribe_audio(file: UploadFile = File(...)):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_audio_file:
-        shutil.copyfileobj(file.file, temp_audio_file)
-        temp_audio_path = temp_audio_file.name
-
     try:
         client = get_openai_client()
-        with open(temp_audio_path, "rb") as audio_file_to_transcribe:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file_to_transcribe
-            )
+        # 直接將 UploadFile 底層的 SpooledTemporaryFile 交給 Whisper，免去暫存檔複製；
+        # 同步的 OpenAI 呼叫交由執行緒執行，避免阻塞事件迴圈
+        await file.seek(0)
+        transcript = await asyncio.to_thread(
+            client.audio.transcriptions.create,
+            model="whisper-1",
+            file=(file.filename or "audio.webm", file.file, file.content_type or "audio/webm"),
+        )
         return {"transcript": transcript.text}
     except Exception as e:
         logging.error(f"Whisper API 轉錄失敗: {e}")
         raise HTTPException(status_code=500, detail=f"語音轉文字失敗: {e}")
-    finally:
-        if os.path.exists(temp_audio_path):
-            os.remove(temp_audio_path)
 
 
 @router.post("/soap-summary")
@@ -138,122 +200,183 @@ async def generate_soap_summary(request: SoapSummaryRequest, current_user: User
     if current_user.role != "Doctor":
         raise HTTPException(status_code=403, detail="權限不足")
     
-    # 重新導入模型以確保最新狀態
-    from ..ai import gemini_model as current_gemini_model
+    current_gemini_model = get_gemini_model()
     
     if not current_gemini_model:
         raise HTTPException(status_code=500, detail="Gemini 模型未能成功載入，請檢查伺服器日誌。")
 
-    prompt = f"""
-    角色：你是一位專業的醫療記錄專家，專門將醫病對話逐字稿轉換成標準的 SOAP 格式醫療記錄。
+    prompt = _SOAP_PROMPT_HEAD + request.transcript + _SOAP_PROMPT_TAIL
 
-    任務：請將以下的「醫病對話逐字稿」，轉換成標準的 SOAP 格式醫療記錄。
+    try:
+        soap_text = (await call_gemini_with_retry(current_gemini_model, prompt, "soap")).strip()
+        return _parse_soap_text(soap_text)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"SOAP summary generation failed: {e}")
+        raise HTTPException(status_code=500, detail=f"生成 SOAP 摘要失敗: {e}")
 
-    SOAP 格式說明：
-    - S (Subjective): 主觀症狀 - 病患描述的主訴、症狀、感受
-    - O (Objective): 客觀發現 - 醫師觀察到的客觀事實、檢查結果、生命徵象
-    - A (Assessment): 評估 - 醫師的診斷、判斷、分析
-    - P (Plan): 計畫 - 治療計畫、用藥、追蹤、衛教
 
-    重要規則：
-    1. 嚴格按照 SOAP 格式分類資訊
-    2. 使用專業但簡潔的醫療術語
-    3. 內容必須基於逐字稿，不可添加額外資訊
-    4. 使用繁體中文
-    5. 每個部分都要有具體內容，如果某部分沒有資訊則標註「無」
+@router.post("/summarize/stream")
+async def stream_summarize_text(transcript_data: TranscriptData, current_user: User = Depends(get_current_user)):
+    """
+    以 Server-Sent Events 串流回傳看診摘要
+    
+    生成過程中逐段送出 chunk 事件（原始文字），結束時送出 done 事件（已正規化的完整摘要）。
+    """
+    if current_user.role != "Doctor":
+        raise HTTPException(status_code=403, detail="權限不足")
+    
+    current_gemini_model = get_gemini_model()
+    
+    if not current_gemini_model:
+        raise HTTPException(status_code=500, detail="Gemini 模型未能成功載入，請檢查伺服器日誌。")
 
-    醫病對話逐字稿：
-    ---
-    {request.transcript}
-    ---
+    prompt = _SUMMARY_PROMPT_HEAD + transcript_data.text + _SUMMARY_PROMPT_TAIL
 
-    請按照以下 JSON 格式回傳 SOAP 摘要：
-    {{
-        "subjective": "主觀症狀內容",
-        "objective": "客觀發現內容", 
-        "assessment": "評估內容",
-        "plan": "計畫內容"
-    }}
+    async def event_stream():
+        parts = []
+        try:
+            async for text in stream_generate(current_gemini_model, prompt, "summary"):
+                parts.append(text)
+                yield _format_chunk_event(text)
+            summary_text = normalize_summary_markdown("".join(parts))
+            logging.info(f"Gemini streamed summary generated for user {current_user.username}")
+            yield format_sse_event('done', {'summary': summary_text.strip()})
+        except Exception as e:
+            logging.error(f"Streaming summarization failed with Gemini API: {e}")
+            yield format_sse_event('error', {'detail': f"生成摘要失敗: {e}"})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.post("/soap-summary/stream")
+async def stream_soap_summary(request: SoapSummaryRequest, current_user: User = Depends(get_current_user)):
     """
+    以 Server-Sent Events 串流回傳 SOAP 摘要
+    
+    生成過程中送出 progress 事件（累計字數），JSON 僅在完整回應後解析，於 done 事件送出。
+    """
+    if current_user.role != "Doctor":
+        raise HTTPException(status_code=403, detail="權限不足")
+    
+    current_gemini_model = get_gemini_model()
+    
+    if not current_gemini_model:
+        raise HTTPException(status_code=500, detail="Gemini 模型未能成功載入，請檢查伺服器日誌。")
+
+    prompt = _SOAP_PROMPT_HEAD + request.transcript + _SOAP_PROMPT_TAIL
+
+    async def event_stream():
+        parts = []
+        received = 0
+        try:
+            async for text in stream_generate(current_gemini_model, prompt, "soap"):
+                parts.append(text)
+                received += len(text)
+                yield _format_progress_event(received)
+            yield format_sse_event('done', _parse_soap_text("".join(parts).strip()))
+        except Exception as e:
+            logging.error(f"Streaming SOAP summary generation failed: {e}")
+            yield format_sse_event('error', {'detail': f"生成 SOAP 摘要失敗: {e}"})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
 
+def _parse_soap_text(soap_text: str) -> dict:
+    """將 Gemini 回傳的 SOAP 文字解析為四段式字典；非 JSON 時退回關鍵字解析"""
+    # 清理回應文字，移除可能的 markdown 格式，再嘗試解析 JSON
+    soap_text = _TAIL_FENCE.sub('', _JSON_FENCE.sub('', soap_text)).strip()
+    
     try:
-        # 添加重試機制
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                response = await current_gemini_model.generate_content_async(prompt)
-                soap_text = response.text.strip()
-                break
-            except Exception as e:
-                error_msg = str(e)
-                if "quota" in error_msg.lower() or "429" in error_msg:
-                    if attempt < max_retries - 1:
-                        wait_time = (attempt + 1) * 10
-                        logging.warning(f"SOAP API 配額限制，等待 {wait_time} 秒後重試 (嘗試 {attempt + 1}/{max_retries})")
-                        await asyncio.sleep(wait_time)
-                        continue
-                    else:
-                        logging.error(f"SOAP API 配額已用完: {e}")
-                        raise HTTPException(status_code=429, detail="AI 服務配額已用完，請稍後再試")
-                else:
-                    raise e
-        
-        # 嘗試解析 JSON 格式的回應
-        import json
-        import re
+        soap_data = json.loads(soap_text)
+        return soap_data
+    except json.JSONDecodeError:
+        # 如果無法解析 JSON，使用關鍵字段落解析：逐行單次掃描，
+        # 含段落關鍵字的行視為該段標題，其後的內容行歸入該段，直到出現其他段落的關鍵字
+        soap_data = dict(_SOAP_DEFAULTS)
+        filled = set()
+        current = None
+        for line in soap_text.split('\n'):
+            line = line.strip()
+            match = _SOAP_SECTION_RE.search(line)
+            if match and match.lastgroup != current:
+                # 每個段落只採用第一次出現的位置
+                current = match.lastgroup if match.lastgroup not in filled else None
+                if current:
+                    filled.add(current)
+                    soap_data[current] = []
+                continue
+            if current and line:
+                soap_data[current].append(line)
         
-        # 清理回應文字，移除可能的 markdown 格式
-        soap_text = re.sub(r'```json\s*', '', soap_text)
-        soap_text = re.sub(r'```\s*$', '', soap_text)
-        soap_text = soap_text.strip()
-        
-        try:
-            soap_data = json.loads(soap_text)
-            return soap_data
-        except json.JSONDecodeError:
-            # 如果無法解析 JSON，使用智能文字解析
-            soap_data = {
-                "subjective": "無主觀症狀描述",
-                "objective": "無客觀發現", 
-                "assessment": "無評估結果",
-                "plan": "無治療計畫"
-            }
-            
-            # 智能文字解析
-            text_lower = soap_text.lower()
-            
-            # 尋找各段落
-            sections = {
-                'subjective': ['subjective', '主觀', 's:', '症狀'],
-                'objective': ['objective', '客觀', 'o:', '發現'],
-                'assessment': ['assessment', '評估', 'a:', '診斷'],
-                'plan': ['plan', '計畫', 'p:', '治療']
-            }
-            
-            for section, keywords in sections.items():
-                for keyword in keywords:
-                    if keyword in text_lower:
-                        # 找到關鍵字後，提取該段落內容
-                        start_idx = text_lower.find(keyword)
-                        if start_idx != -1:
-                            # 提取從關鍵字開始到下一段落或結尾的內容
-                            remaining_text = soap_text[start_idx:]
-                            lines = remaining_text.split('\n')
-                            content_lines = []
-                            
-                            for line in lines[1:]:  # 跳過包含關鍵字的第一行
-                                line = line.strip()
-                                if line and not any(other_keyword in line.lower() for other_section, other_keywords in sections.items() if other_section != section for other_keyword in other_keywords):
-                                    content_lines.append(line)
-                                elif line and any(other_keyword in line.lower() for other_section, other_keywords in sections.items() if other_section != section for other_keyword in other_keywords):
-                                    break
-                            
-                            if content_lines:
-                                soap_data[section] = '\n'.join(content_lines)
-                            break
-            
-            return soap_data
-            
+        for section in filled:
+            soap_data[section] = '\n'.join(soap_data[section]) or _SOAP_DEFAULTS[section]
+        return soap_data
+
+
+@router.post("/summarize/batch", status_code=202)
+def submit_summary_batch(request: BatchSummaryRequest, background_tasks: BackgroundTasks, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """
+    以 Gemini Batch API 離線生成多筆看診摘要（費用約為即時呼叫的一半，最長 24 小時完成）
+    
+    適用於補寫歷史摘要等非即時情境；結果於背景寫入尚未有摘要的看診紀錄，不會覆寫已批准的摘要。
+    """
+    if current_user.role != "Doctor":
+        raise HTTPException(status_code=403, detail="權限不足")
+    if not request.items:
+        raise HTTPException(status_code=400, detail="未提供任何逐字稿")
+    if len(request.items) > SUMMARY_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"單次最多送出 {SUMMARY_BATCH_MAX_ITEMS} 筆逐字稿")
+
+    appointment_ids = [item.appointment_id for item in request.items]
+    if len(set(appointment_ids)) != len(appointment_ids):
+        raise HTTPException(status_code=400, detail="同一看診紀錄不可重複送出")
+    # 所有看診紀錄皆須屬於目前醫生，以單一 COUNT 查詢確認
+    owned_count = (
+        db.query(func.count(AppointmentDB.id))
+        .join(DoctorDB, DoctorDB.id == AppointmentDB.doctor_id)
+        .filter(AppointmentDB.id.in_(appointment_ids), DoctorDB.user_id == current_user.id)
+        .scalar()
+    )
+    if owned_count != len(appointment_ids):
+        raise HTTPException(status_code=404, detail="找不到指定的看診紀錄，或該紀錄不屬於您")
+
+    prompts = [_SUMMARY_PROMPT_HEAD + item.transcript + _SUMMARY_PROMPT_TAIL for item in request.items]
+    try:
+        job_name = submit_gemini_batch(prompts, f"summary-batch-{len(prompts)}")
     except Exception as e:
-        logging.error(f"SOAP summary generation failed: {e}")
-        raise HTTPException(status_code=500, detail=f"生成 SOAP 摘要失敗: {e}")
\ No newline at end of file
+        logging.error(f"送出批次摘要失敗: {e}")
+        raise HTTPException(status_code=500, detail=f"送出批次摘要失敗: {e}")
+
+    background_tasks.add_task(_collect_batch_summaries, job_name, appointment_ids)
+    return {"job_name": job_name, "count": len(prompts)}
+
+
+async def _collect_batch_summaries(job_name: str, appointment_ids: List[int]) -> None:
+    """背景任務：等待批次工作完成後，將正規化的摘要寫回看診紀錄，使用獨立的資料庫 Session"""
+    try:
+        texts = await wait_gemini_batch(job_name)
+    except Exception as e:
+        logging.error(f"批次摘要工作 {job_name} 失敗: {e}")
+        return
+    summaries = {
+        appointment_id: normalize_summary_markdown(text).strip()
+        for appointment_id, text in zip(appointment_ids, texts)
+        if text
+    }
+    await run_in_threadpool(_store_batch_summaries, summaries)
+    logging.info(f"批次摘要工作 {job_name} 完成：{len(summaries)}/{len(appointment_ids)} 筆")
+
+
+def _store_batch_summaries(summaries: Dict[int, str]) -> None:
+    db = SessionLocal()
+    try:
+        for appointment_id, summary in summaries.items():
+            db.query(AppointmentDB).filter(
+                AppointmentDB.id == appointment_id,
+                or_(AppointmentDB.summary.is_(None), AppointmentDB.summary == ""),
+            ).update({AppointmentDB.summary: summary}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
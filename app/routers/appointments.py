@@ -1,28 +1,65 @@
 from datetime import datetime
 import logging
-from fastapi import APIRouter, Depends, HTTPException, Response
-from sqlalchemy.orm import Session, joinedload
+from typing import Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import exists, select
+from sqlalchemy.orm import Session, joinedload, raiseload, selectinload
 
-# from ..ai import gemini_model  # 延遲導入
+from ..ai import call_gemini_with_retry, get_gemini_model
 from ..auth import get_current_user, get_db
+from ..database import SessionLocal
 from ..models import AppointmentDB, DoctorDB, PatientDB, TaskDB
 from ..schemas import Appointment, AppointmentCreate, WalkInAppointmentCreate, User, AppointmentDetail, SummaryUpdate, Task, TaskCreate
 
 
 router = APIRouter(prefix="/appointments", tags=["Appointments"])
 
+_TAGGING_PROMPT_HEAD = """
+        角色：你是一個專業的醫療衛教助理。
+        任務：請仔細分析以下的「看診摘要」，從中提取出所有對病患有用的衛教關鍵字。
+        關鍵字類型應包含：
+        - 疾病或症狀 (例如: 高血壓, 頭晕)
+        - 飲食建議 (例如: 少鹽飲食, 戒酒, 地瓜)
+        - 生活作息建議 (例如: 規律運動, 充足睡眠)
+        - 藥物名稱或類型 (例如: 阿斯匹靈, 降血糖藥)
+        - 追蹤指標 (例如: 血糖監測, 血壓測量)
+        輸出規則：
+        - 每個關鍵字都是一個簡短的詞語。
+        - 所有關鍵字合併成一個單一的字串。
+        - 關鍵字之間用「英文逗號」分隔。
+        - 不要包含 # 符號。
+        - 除了逗號分隔的關鍵字字串，不要有任何其他文字或解釋。
+        看診摘要：
+        ---
+        """
+_TAGGING_PROMPT_TAIL = """
+        ---
+        請生成關鍵字字串：
+        """
+
+
+def _resolve_doctor_for_patient(db: Session, user_id: int, patient_id: int) -> int:
+    """以單一查詢取得目前醫生的 id 並確認病患存在，回傳醫生 id"""
+    row = (
+        db.query(DoctorDB.id, exists().where(PatientDB.id == patient_id))
+        .filter(DoctorDB.user_id == user_id)
+        .first()
+    )
+    if not row:
+        raise HTTPException(status_code=404, detail="找不到對應的醫生資料")
+    doctor_id, patient_exists = row
+    if not patient_exists:
+        raise HTTPException(status_code=404, detail="找不到指定的病患資料")
+    return doctor_id
+
 
 @router.post("/", response_model=Appointment, summary="預約未來看診")
 def create_appointment(appointment: AppointmentCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.role != "Doctor":
         raise HTTPException(status_code=403, detail="權限不足，僅限醫生操作")
-    doctor_profile = db.query(DoctorDB).filter(DoctorDB.user_id == current_user.id).first()
-    if not doctor_profile:
-        raise HTTPException(status_code=404, detail="找不到對應的醫生資料")
-    patient_exists = db.query(PatientDB).filter(PatientDB.id == appointment.patient_id).first()
-    if not patient_exists:
-        raise HTTPException(status_code=404, detail="找不到指定的病患資料")
-    db_appointment = AppointmentDB(**appointment.dict(), doctor_id=doctor_profile.id, appointment_type="scheduled")
+    doctor_id = _resolve_doctor_for_patient(db, current_user.id, appointment.patient_id)
+    db_appointment = AppointmentDB(**appointment.model_dump(), doctor_id=doctor_id, appointment_type="scheduled")
     db.add(db_appointment)
     db.commit()
     db.refresh(db_appointment)
@@ -33,18 +70,13 @@ def create_appointment(appointment: AppointmentCreate, current_user: User = Depe
 def create_walk_in_appointment(walk_in_data: WalkInAppointmentCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.role != "Doctor":
         raise HTTPException(status_code=403, detail="權限不足，僅限醫生操作")
-    doctor_profile = db.query(DoctorDB).filter(DoctorDB.user_id == current_user.id).first()
-    if not doctor_profile:
-        raise HTTPException(status_code=404, detail="找不到對應的醫生資料")
-    patient_exists = db.query(PatientDB).filter(PatientDB.id == walk_in_data.patient_id).first()
-    if not patient_exists:
-        raise HTTPException(status_code=404, detail="找不到指定的病患資料")
+    doctor_id = _resolve_doctor_for_patient(db, current_user.id, walk_in_data.patient_id)
     appointment_time_utc = datetime.utcnow()
     db_appointment = AppointmentDB(
         patient_id=walk_in_data.patient_id,
         reason=walk_in_data.reason,
         appointment_date=appointment_time_utc.isoformat() + "Z",
-        doctor_id=doctor_profile.id,
+        doctor_id=doctor_id,
         created_at=appointment_time_utc,
         appointment_type="walk-in",
     )
@@ -66,69 +98,56 @@ def delete_appointment(appointment_id: int, db: Session = Depends(get_db)):
 
 @router.get("/{appointment_id}/summary", response_model=AppointmentDetail, summary="獲取單一看診的詳細摘要")
 def get_appointment_summary(appointment_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    appointment = db.query(AppointmentDB).filter(AppointmentDB.id == appointment_id).first()
+    # 預先載入回應所需的關聯；raiseload 讓任何遺漏的延遲載入立即報錯，避免 N+1 悄悄回歸
+    query = (
+        db.query(AppointmentDB)
+        .options(joinedload(AppointmentDB.doctor), selectinload(AppointmentDB.tasks), raiseload("*"))
+        .filter(AppointmentDB.id == appointment_id)
+    )
+    if current_user.role == "Patient":
+        # 病患僅能查看自己的看診：歸屬檢查併入同一查詢，不存在與非本人一律回 404
+        query = query.join(PatientDB, PatientDB.id == AppointmentDB.patient_id).filter(PatientDB.user_id == current_user.id)
+    appointment = query.first()
     if not appointment:
         raise HTTPException(status_code=404, detail="找不到該看診紀錄")
-    if current_user.role == "Patient":
-        patient_profile = db.query(PatientDB).filter(PatientDB.user_id == current_user.id).first()
-        if not patient_profile or appointment.patient_id != patient_profile.id:
-            raise HTTPException(status_code=403, detail="權限不足，無法查看此看診紀錄")
     if not appointment.summary:
         appointment.summary = "醫生尚未批准或撰寫本次看診的摘要。"
     return appointment
 
 
 @router.post("/{appointment_id}/summary", status_code=200, summary="批准並發送摘要")
-async def approve_and_send_summary(appointment_id: int, summary_data: SummaryUpdate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def approve_and_send_summary(appointment_id: int, summary_data: SummaryUpdate, background_tasks: BackgroundTasks, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.role != "Doctor":
         raise HTTPException(status_code=403, detail="權限不足，僅限醫生操作")
-    doctor_profile = db.query(DoctorDB).filter(DoctorDB.user_id == current_user.id).first()
-    if not doctor_profile:
-        raise HTTPException(status_code=404, detail="找不到對應的醫生資料")
-    appointment = db.query(AppointmentDB).options(joinedload(AppointmentDB.patient)).filter(AppointmentDB.id == appointment_id).first()
-    if not appointment:
-        raise HTTPException(status_code=404, detail="找不到該看診紀錄")
-    if appointment.doctor_id != doctor_profile.id:
+    # 歸屬檢查併入單一 UPDATE：僅更新屬於目前醫生的看診紀錄，不必先 SELECT 再修改
+    updated = (
+        db.query(AppointmentDB)
+        .filter(
+            AppointmentDB.id == appointment_id,
+            AppointmentDB.doctor_id.in_(select(DoctorDB.id).where(DoctorDB.user_id == current_user.id)),
+        )
+        .update({AppointmentDB.summary: summary_data.summary}, synchronize_session=False)
+    )
+    if not updated:
+        db.rollback()
+        # 未更新任何列時才查明原因，維持原本 404／403 的區分
+        row = (
+            db.query(DoctorDB.id, AppointmentDB.id)
+            .outerjoin(AppointmentDB, AppointmentDB.id == appointment_id)
+            .filter(DoctorDB.user_id == current_user.id)
+            .first()
+        )
+        if not row:
+            raise HTTPException(status_code=404, detail="找不到對應的醫生資料")
+        if row[1] is None:
+            raise HTTPException(status_code=404, detail="找不到該看診紀錄")
         raise HTTPException(status_code=403, detail="權限不足，無法修改非自己的看診紀錄")
-    appointment.summary = summary_data.summary
-    
-    # 重新導入 gemini_model 以確保最新狀態
-    from ..ai import gemini_model as current_gemini_model
-    logging.info(f"準備生成標籤 - gemini_model: {current_gemini_model is not None}, summary: '{summary_data.summary}'")
-    if current_gemini_model and summary_data.summary:
-        tagging_prompt = f"""
-        角色：你是一個專業的醫療衛教助理。
-        任務：請仔細分析以下的「看診摘要」，從中提取出所有對病患有用的衛教關鍵字。
-        關鍵字類型應包含：
-        - 疾病或症狀 (例如: 高血壓, 頭晕)
-        - 飲食建議 (例如: 少鹽飲食, 戒酒, 地瓜)
-        - 生活作息建議 (例如: 規律運動, 充足睡眠)
-        - 藥物名稱或類型 (例如: 阿斯匹靈, 降血糖藥)
-        - 追蹤指標 (例如: 血糖監測, 血壓測量)
-        輸出規則：
-        - 每個關鍵字都是一個簡短的詞語。
-        - 所有關鍵字合併成一個單一的字串。
-        - 關鍵字之間用「英文逗號」分隔。
-        - 不要包含 # 符號。
-        - 除了逗號分隔的關鍵字字串，不要有任何其他文字或解釋。
-        看診摘要：
-        ---
-        {summary_data.summary}
-        ---
-        請生成關鍵字字串：
-        """
-        try:
-            logging.info(f"正在為約診 {appointment.id} 生成衛教標籤...")
-            response = await current_gemini_model.generate_content_async(tagging_prompt)
-            generated_tags = response.text.strip()
-            appointment.tags = generated_tags
-            logging.info(f"成功生成標籤: {generated_tags}")
-        except Exception as e:
-            logging.error(f"生成衛教標籤失敗: {e}")
-            appointment.tags = None
     db.commit()
-    db.refresh(appointment)
-    return {"message": "摘要與衛教標籤已成功儲存"}
+    
+    # 衛教標籤生成需等待 Gemini 數秒，改於回應送出後以背景任務處理（使用獨立的 Session）
+    if summary_data.summary:
+        background_tasks.add_task(_generate_and_store_tags, appointment_id, summary_data.summary)
+    return {"message": "摘要已儲存，衛教標籤生成中"}
 
 
 @router.post("/{appointment_id}/tasks", response_model=Task, summary="為特定看診建立任務")
@@ -136,17 +155,19 @@ def create_appointment_task(appointment_id: int, task: TaskCreate, current_user:
     if current_user.role != "Patient":
         raise HTTPException(status_code=403, detail="權限不足，僅限病患操作")
     
-    # 檢查病患身份
-    patient_profile = db.query(PatientDB).filter(PatientDB.user_id == current_user.id).first()
-    if not patient_profile:
+    # 檢查病患身份，並於同一查詢確認看診記錄屬於該病患
+    row = (
+        db.query(
+            PatientDB.id,
+            exists().where(AppointmentDB.id == appointment_id, AppointmentDB.patient_id == PatientDB.id),
+        )
+        .filter(PatientDB.user_id == current_user.id)
+        .first()
+    )
+    if not row:
         raise HTTPException(status_code=404, detail="找不到對應的病患資料")
-    
-    # 檢查看診記錄是否屬於該病患
-    appointment = db.query(AppointmentDB).filter(
-        AppointmentDB.id == appointment_id, 
-        AppointmentDB.patient_id == patient_profile.id
-    ).first()
-    if not appointment:
+    patient_id, owns_appointment = row
+    if not owns_appointment:
         raise HTTPException(status_code=404, detail="找不到指定的看診紀錄，或該紀錄不屬於您")
     
     # 建立任務
@@ -154,7 +175,7 @@ def create_appointment_task(appointment_id: int, task: TaskCreate, current_user:
         description=task.description,
         due_date=task.due_date,
         appointment_id=appointment_id,
-        patient_id=patient_profile.id
+        patient_id=patient_id
     )
     db.add(db_task)
     db.commit()
@@ -162,3 +183,28 @@ def create_appointment_task(appointment_id: int, task: TaskCreate, current_user:
     return db_task
 
 
+async def _generate_and_store_tags(appointment_id: int, summary: str) -> None:
+    """背景任務：為看診摘要生成衛教標籤並寫回，使用獨立的資料庫 Session"""
+    current_gemini_model = get_gemini_model()
+    logging.info(f"準備生成標籤 - gemini_model: {current_gemini_model is not None}, summary: '{summary}'")
+    if not current_gemini_model:
+        return
+    try:
+        logging.info(f"正在為約診 {appointment_id} 生成衛教標籤...")
+        generated_tags = (await call_gemini_with_retry(current_gemini_model, _TAGGING_PROMPT_HEAD + summary + _TAGGING_PROMPT_TAIL, "tags")).strip()
+        logging.info(f"成功生成標籤: {generated_tags}")
+    except Exception as e:
+        logging.error(f"生成衛教標籤失敗: {e}")
+        generated_tags = None
+    await run_in_threadpool(_store_tags, appointment_id, generated_tags)
+
+
+def _store_tags(appointment_id: int, tags: Optional[str]) -> None:
+    db = SessionLocal()
+    try:
+        db.query(AppointmentDB).filter(AppointmentDB.id == appointment_id).update(
+            {AppointmentDB.tags: tags}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
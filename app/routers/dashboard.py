@@ -1,5 +1,6 @@
 from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import and_
 from sqlalchemy.orm import Session
 
 from ..auth import get_current_user, get_db
@@ -14,18 +15,27 @@ router = APIRouter(tags=["Dashboard"])
 def get_dashboard_data(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     if current_user.role != "Patient":
         raise HTTPException(status_code=403, detail="僅限病患存取")
-    patient_profile = db.query(PatientDB).filter(PatientDB.user_id == current_user.id).first()
-    if not patient_profile:
-        raise HTTPException(status_code=404, detail="找不到對應的病患資料")
-    next_appointment = (
-        db.query(AppointmentDB)
-        .filter(
-            AppointmentDB.patient_id == patient_profile.id,
-            AppointmentDB.appointment_date >= datetime.now().strftime("%Y-%m-%d"),
+    # appointment_date 以 ISO 8601 字串（UTC，如 walk-in 的 "...Z"）儲存，字典序即時間序；
+    # 以 UTC 當日日期作為下界，直接走 (patient_id, appointment_date) 索引範圍掃描
+    today_utc = datetime.utcnow().date().isoformat()
+    # 病患資料與下一次看診以 LEFT JOIN 合併為單一查詢，省去一次往返
+    row = (
+        db.query(PatientDB, AppointmentDB)
+        .outerjoin(
+            AppointmentDB,
+            and_(
+                AppointmentDB.patient_id == PatientDB.id,
+                AppointmentDB.appointment_date >= today_utc,
+            ),
         )
+        .filter(PatientDB.user_id == current_user.id)
         .order_by(AppointmentDB.appointment_date.asc())
+        .limit(1)
         .first()
     )
+    if row is None:
+        raise HTTPException(status_code=404, detail="找不到對應的病患資料")
+    patient_profile, next_appointment = row
     pending_tasks = db.query(TaskDB).filter(TaskDB.patient_id == patient_profile.id, TaskDB.is_completed == False).all()
     return DashboardData(next_appointment=next_appointment, pending_tasks=pending_tasks)
 
@@ -1,5 +1,6 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Response
+from pydantic import TypeAdapter
+from sqlalchemy.orm import Session, joinedload, load_only, raiseload
 from typing import List
 
 from ..database import get_db
@@ -9,6 +10,24 @@ from ..auth import get_current_user
 
 router = APIRouter(prefix="/doctors", tags=["Doctors"])
 
+# /me/appointments 只輸出下列欄位（不含 tags 等），tasks 固定回傳空清單而不需載入；
+# 病患以 JOIN 一併取回，其餘關聯一律 raiseload，避免建構 AppointmentForDoctor 時悄悄產生 N+1
+_DOCTOR_APPOINTMENT_OPTIONS = (
+    load_only(
+        AppointmentDB.id,
+        AppointmentDB.appointment_date,
+        AppointmentDB.reason,
+        AppointmentDB.appointment_type,
+        AppointmentDB.created_at,
+        AppointmentDB.summary,
+        AppointmentDB.patient_id,
+    ),
+    joinedload(AppointmentDB.patient),
+    raiseload("*"),
+)
+# 預約清單已組成 AppointmentForDoctor，直接由 pydantic-core 序列化為 JSON，不再經 FastAPI 重新驗證一次
+_DOCTOR_APPOINTMENT_LIST_ADAPTER = TypeAdapter(List[AppointmentForDoctor])
+
 @router.get("/me", response_model=Doctor)
 async def get_current_doctor(current_user: User = Depends(get_current_user)):
     """獲取當前醫生資訊"""
@@ -28,7 +47,7 @@ async def create_doctor(doctor: Doctor, current_user: User = Depends(get_current
     return doctor
 
 @router.get("/me/patients", response_model=List[Patient])
-async def get_my_patients(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_my_patients(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     """獲取當前醫生的病患列表"""
     if current_user.role != "Doctor":
         raise HTTPException(status_code=403, detail="權限不足，僅限醫生操作")
@@ -40,20 +59,22 @@ async def get_my_patients(current_user: User = Depends(get_current_user), db: Se
         patients = db.query(PatientDB).all()
         return patients
     
-    # 獲取該醫生的所有病患（通過預約記錄）
-    appointments = db.query(AppointmentDB).filter(AppointmentDB.doctor_id == doctor.id).all()
-    patient_ids = list(set([appt.patient_id for appt in appointments]))
+    # 獲取該醫生的所有病患（通過預約記錄，單一 JOIN 查詢去重）
+    patients = (
+        db.query(PatientDB)
+        .join(AppointmentDB, AppointmentDB.patient_id == PatientDB.id)
+        .filter(AppointmentDB.doctor_id == doctor.id)
+        .distinct()
+        .all()
+    )
     
-    if not patient_ids:
+    if not patients:
         # 如果沒有預約，返回所有病患供選擇
         patients = db.query(PatientDB).all()
-        return patients
-    
-    patients = db.query(PatientDB).filter(PatientDB.id.in_(patient_ids)).all()
     return patients
 
 @router.get("/me/appointments", response_model=List[AppointmentForDoctor])
-async def get_my_appointments(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_my_appointments(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     """獲取當前醫生的預約列表"""
     if current_user.role != "Doctor":
         raise HTTPException(status_code=403, detail="權限不足，僅限醫生操作")
@@ -62,14 +83,19 @@ async def get_my_appointments(current_user: User = Depends(get_current_user), db
     doctor = db.query(DoctorDB).filter(DoctorDB.user_id == current_user.id).first()
     if not doctor:
         # 如果沒有醫生記錄，返回所有預約（用於測試）
-        appointments = db.query(AppointmentDB).all()
+        appointments = db.query(AppointmentDB).options(*_DOCTOR_APPOINTMENT_OPTIONS).all()
     else:
-        # 獲取該醫生的所有預約
-        appointments = db.query(AppointmentDB).filter(AppointmentDB.doctor_id == doctor.id).all()
+        # 獲取該醫生的所有預約（一併載入病患，避免逐筆查詢）
+        appointments = (
+            db.query(AppointmentDB)
+            .options(*_DOCTOR_APPOINTMENT_OPTIONS)
+            .filter(AppointmentDB.doctor_id == doctor.id)
+            .all()
+        )
     
     result = []
     for appt in appointments:
-        patient = db.query(PatientDB).filter(PatientDB.id == appt.patient_id).first()
+        patient = appt.patient
         if patient:
             result.append(AppointmentForDoctor(
                 id=appt.id,
@@ -82,4 +108,4 @@ async def get_my_appointments(current_user: User = Depends(get_current_user), db
                 summary=getattr(appt, 'summary', None)
             ))
     
-    return result
\ No newline at end of file
+    return Response(_DOCTOR_APPOINTMENT_LIST_ADAPTER.dump_json(result), media_type="application/json")
\ No newline at end of file
@@ -1,26 +1,76 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from datetime import datetime
+from typing import Iterator, List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+from sqlalchemy import and_, exists, or_, select
+from sqlalchemy.orm import Session, raiseload
 
 from ..auth import get_db, get_current_user, get_password_hash
+from ..database import SessionLocal
 from ..models import PatientDB, UserDB, PrescriptionDB
 from ..schemas import Patient, PatientCreate, User, Prescription
 
 
 router = APIRouter(prefix="/patients", tags=["Patients"])
 
+# 分頁每頁上限
+MAX_PAGE_SIZE = 500
+
+# 病患清單由 pydantic-core 直接驗證並序列化為 JSON 位元組，略過 FastAPI 的 dict 中介與 json.dumps
+_PATIENT_LIST_ADAPTER = TypeAdapter(List[Patient])
+
+# 未分頁的完整清單改以串流輸出：每批列數（資料庫游標 yield_per 與 JSON 片段大小）
+PATIENT_STREAM_BATCH_SIZE = 500
+
+
+def _stream_patient_list(after_id: Optional[int]) -> Iterator[bytes]:
+    """逐批讀取病患並輸出 JSON 陣列片段，記憶體用量與首位元組延遲不隨病患總數成長"""
+    # 串流在端點返回後才進行，此時請求的 Session 已關閉，因此使用獨立的 Session
+    db = SessionLocal()
+    try:
+        stmt = (
+            select(PatientDB)
+            .order_by(PatientDB.id.asc())
+            .execution_options(yield_per=PATIENT_STREAM_BATCH_SIZE)
+        )
+        if after_id is not None:
+            stmt = stmt.where(PatientDB.id > after_id)
+        yield b"["
+        separator = b""
+        for batch in db.scalars(stmt).partitions():
+            # 整批序列化為 JSON 陣列後去掉外層方括號，與其他批次以逗號串接
+            yield separator + _PATIENT_LIST_ADAPTER.dump_json(_PATIENT_LIST_ADAPTER.validate_python(batch))[1:-1]
+            separator = b","
+        yield b"]"
+    finally:
+        db.close()
+
 
 @router.get("/", response_model=List[Patient])
-def list_patients(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def list_patients(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after_id: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
     # 醫師或病患皆可讀取病患清單（醫師用於建立預約，病患用於查詢自身資訊）
-    patients = db.query(PatientDB).all()
-    return patients
+    # 提供 limit / after_id 時以 id 做 keyset 分頁；未提供 limit 則串流回傳完整清單
+    if limit is None:
+        return StreamingResponse(_stream_patient_list(after_id), media_type="application/json")
+    query = db.query(PatientDB)
+    if after_id is not None:
+        query = query.filter(PatientDB.id > after_id)
+    query = query.order_by(PatientDB.id.asc()).limit(limit)
+    patients = _PATIENT_LIST_ADAPTER.validate_python(query.all())
+    return Response(_PATIENT_LIST_ADAPTER.dump_json(patients), media_type="application/json")
 
 
 @router.post("/", response_model=Patient)
 def create_patient(data: PatientCreate, db: Session = Depends(get_db)):
     # 建立使用者帳號
-    if db.query(UserDB).filter(UserDB.username == data.credentials.username).first():
+    # 只需確認帳號是否存在，以 EXISTS 查詢取代載入整列（含密碼雜湊）
+    if db.query(exists().where(UserDB.username == data.credentials.username)).scalar():
         raise HTTPException(status_code=400, detail="此帳號已存在")
 
     user = UserDB(
@@ -29,8 +79,8 @@ def create_patient(data: PatientCreate, db: Session = Depends(get_db)):
         role="Patient",
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    # 先 flush 取得 user.id，帳號與病患資料於同一交易中一次提交
+    db.flush()
 
     patient = PatientDB(
         name=data.name,
@@ -39,20 +89,47 @@ def create_patient(data: PatientCreate, db: Session = Depends(get_db)):
         user_id=user.id,
     )
     db.add(patient)
+    # flush 後 id 與 Python 端預設的時間戳皆已填入，提交前先建立回應，省去 commit 後 refresh 的 SELECT
+    db.flush()
+    result = Patient.model_validate(patient)
     db.commit()
-    db.refresh(patient)
 
-    return patient
+    return result
 
 
 @router.get("/{patient_id}/prescriptions", response_model=List[Prescription])
-def list_patient_prescriptions(patient_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    # 醫師可查看任何病患的處方；病患只能查看自己的
+def list_patient_prescriptions(
+    patient_id: int,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after_created_at: Optional[datetime] = None,
+    after_id: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    # 醫師可查看任何病患的處方；病患只能查看自己的，歸屬檢查併入同一查詢
+    # Prescription 回應不含任何關聯；raiseload 確保日後新增巢狀欄位時不會悄悄逐筆延遲載入
+    query = db.query(PrescriptionDB).options(raiseload("*")).filter(PrescriptionDB.patient_id == patient_id)
     if current_user.role == "Patient":
-        patient_profile = db.query(PatientDB).filter(PatientDB.user_id == current_user.id).first()
-        if not patient_profile or patient_profile.id != patient_id:
+        query = query.join(PatientDB, PatientDB.id == PrescriptionDB.patient_id).filter(PatientDB.user_id == current_user.id)
+    # 以 (created_at, id) 做 keyset 分頁：取上一頁最後一筆之後（較舊）的處方
+    if after_created_at is not None and after_id is not None:
+        query = query.filter(
+            or_(
+                PrescriptionDB.created_at < after_created_at,
+                and_(PrescriptionDB.created_at == after_created_at, PrescriptionDB.id < after_id),
+            )
+        )
+    query = query.order_by(PrescriptionDB.created_at.desc(), PrescriptionDB.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    prescriptions = query.all()
+    if not prescriptions and current_user.role == "Patient":
+        # 結果為空時才確認是否為本人，區分「沒有處方」與「權限不足」
+        is_owner = db.query(
+            exists().where(PatientDB.id == patient_id, PatientDB.user_id == current_user.id)
+        ).scalar()
+        if not is_owner:
             raise HTTPException(status_code=403, detail="權限不足")
-    prescriptions = db.query(PrescriptionDB).filter(PrescriptionDB.patient_id == patient_id).order_by(PrescriptionDB.created_at.desc()).all()
     return prescriptions
 
 
@@ -1,6 +1,7 @@
 from typing import List
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import exists
+from sqlalchemy.orm import Session, raiseload
 
 from ..auth import get_db, get_current_user
 from ..models import TaskDB, PatientDB
@@ -12,12 +13,19 @@ router = APIRouter(prefix="/tasks", tags=["Tasks"])
 
 @router.get("/patient/{patient_id}", response_model=List[Task])
 def list_tasks_for_patient(patient_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    # 僅允許病患本人或醫師查詢
+    # 僅允許病患本人或醫師查詢；病患的歸屬檢查併入同一查詢
+    # Task 回應不含任何關聯；raiseload 確保日後新增巢狀欄位時不會悄悄逐筆延遲載入
+    query = db.query(TaskDB).options(raiseload("*")).filter(TaskDB.patient_id == patient_id)
     if current_user.role == "Patient":
-        patient_profile = db.query(PatientDB).filter(PatientDB.user_id == current_user.id).first()
-        if not patient_profile or patient_profile.id != patient_id:
+        query = query.join(PatientDB, PatientDB.id == TaskDB.patient_id).filter(PatientDB.user_id == current_user.id)
+    tasks = query.all()
+    if not tasks and current_user.role == "Patient":
+        # 結果為空時才確認是否為本人，區分「沒有任務」與「權限不足」
+        is_owner = db.query(
+            exists().where(PatientDB.id == patient_id, PatientDB.user_id == current_user.id)
+        ).scalar()
+        if not is_owner:
             raise HTTPException(status_code=403, detail="權限不足")
-    tasks = db.query(TaskDB).filter(TaskDB.patient_id == patient_id).all()
     return tasks
 
 
@@ -1,16 +1,58 @@
+import asyncio
+import bisect
+import hashlib
+import json
 import logging
-from fastapi import APIRouter, Depends, HTTPException
+import time
+from collections import OrderedDict
+from operator import attrgetter
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
-from ..auth import get_current_user
+from ..auth import require_doctor
 from ..schemas import User
 from ..ai_agent import medical_validator
 from ..utils.markdown_utils import normalize_summary_markdown
+from ..utils.sse_utils import SSE_HEADERS, format_sse_event
 
 
 router = APIRouter(prefix="/validation", tags=["AI Validation"])
 
+# 路由層回應快取：同一醫師編修過程中重送相同的（逐字稿, 摘要）時直接回傳已格式化的結果
+RESPONSE_CACHE_MAX_ENTRIES = 512
+RESPONSE_CACHE_TTL_SECONDS = 1800
+_response_cache = OrderedDict()  # key -> (到期時間, 回應 dict)
+
+# 超過此長度的摘要改在執行緒池中正規化；短文直接處理以免切換執行緒的額外成本
+OFFLOAD_NORMALIZE_MIN_CHARS = 4096
+
+
+def _response_cache_key(kind: str, transcript: str, summary: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (transcript, summary):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return f"{kind}:{digest.hexdigest()}"
+
+
+def _response_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    entry = _response_cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        del _response_cache[key]
+        return None
+    _response_cache.move_to_end(key)
+    return entry[1]
+
+
+def _response_cache_put(key: str, value: Dict[str, Any]) -> None:
+    _response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL_SECONDS, value)
+    while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+        _response_cache.popitem(last=False)
+
 
 class ValidationRequest(BaseModel):
     transcript: str
@@ -29,12 +71,13 @@ class ValidationResponse(BaseModel):
     anomalies: list
     overall_score: int
     recommendations: list
+    short_circuit: bool = False
 
 
 @router.post("/validate-summary", response_model=ValidationResponse, summary="AI 摘要品質驗證")
 async def validate_medical_summary(
     request: ValidationRequest, 
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(require_doctor)
 ):
     """
     AI Agent 進行醫療摘要品質驗證
@@ -45,8 +88,11 @@ async def validate_medical_summary(
     3. 潛在遺漏提醒
     4. 異常數值標記
     """
-    if current_user.role != "Doctor":
-        raise HTTPException(status_code=403, detail="權限不足，僅限醫生操作")
+    cache_key = _response_cache_key("validate", request.transcript, request.summary)
+    cached = _response_cache_get(cache_key)
+    if cached is not None:
+        logging.info(f"摘要驗證命中快取 - 用戶: {current_user.username}")
+        return JSONResponse(cached)
     
     try:
         logging.info(f"開始進行摘要驗證 - 用戶: {current_user.username}")
@@ -65,61 +111,102 @@ async def validate_medical_summary(
         
         # 格式化回應
         response_data = {
-            'fact_consistency': [
-                {
-                    'level': result.level.value,
-                    'message': result.message,
-                    'category': result.category,
-                    'suggestion': result.suggestion
-                }
-                for result in validation_result['fact_consistency']
-            ],
-            'highlights': [
-                {
-                    'text': highlight.text,
-                    'start_pos': highlight.start_pos,
-                    'end_pos': highlight.end_pos,
-                    'category': highlight.category,
-                    'confidence': highlight.confidence,
-                    'importance': highlight.importance
-                }
-                for highlight in validation_result['highlights']
-            ],
-            'missing_alerts': [
-                {
-                    'level': result.level.value,
-                    'message': result.message,
-                    'category': result.category,
-                    'suggestion': result.suggestion
-                }
-                for result in validation_result['missing_alerts']
-            ],
-            'anomalies': [
-                {
-                    'value': anomaly.value,
-                    'normal_range': anomaly.normal_range,
-                    'severity': anomaly.severity,
-                    'suggestion': anomaly.suggestion,
-                    'position': anomaly.position
-                }
-                for anomaly in validation_result['anomalies']
-            ],
+            'fact_consistency': _format_validation_results(validation_result['fact_consistency']),
+            'highlights': _format_highlights(validation_result['highlights']),
+            'missing_alerts': _format_validation_results(validation_result['missing_alerts']),
+            'anomalies': _format_anomalies(validation_result['anomalies']),
             'overall_score': validation_result['overall_score'],
-            'recommendations': recommendations
+            'recommendations': recommendations,
+            'short_circuit': validation_result.get('short_circuit', False)
         }
         
         logging.info(f"摘要驗證完成 - 整體分數: {validation_result['overall_score']}")
-        return ValidationResponse(**response_data)
+        # 部分區段失敗的降級結果不快取，下次請求重新驗證
+        if not validation_result.get('degraded'):
+            _response_cache_put(cache_key, response_data)
+        # response_data 由內部驗證器產生、僅含基本型別，直接序列化而不再經 Pydantic 逐欄驗證；
+        # response_model 保留作為 API 文件
+        return JSONResponse(response_data)
         
     except Exception as e:
         logging.error(f"摘要驗證失敗: {e}")
         raise HTTPException(status_code=500, detail=f"摘要驗證失敗: {str(e)}")
 
 
+@router.post("/validate-summary/stream", summary="AI 摘要品質驗證（串流）")
+async def stream_validate_medical_summary(
+    request: ValidationRequest, 
+    current_user: User = Depends(require_doctor)
+):
+    """
+    以 Server-Sent Events 串流回傳驗證結果
+    
+    每個區段完成即送出一個事件（event 為區段名稱），最後送出 recommendations 與 done。
+    """
+    logging.info(f"開始進行串流摘要驗證 - 用戶: {current_user.username}")
+    
+    async def event_stream():
+        validation_result = {}
+        try:
+            async for section, value in medical_validator.stream_validation(
+                transcript=request.transcript,
+                summary=request.summary
+            ):
+                validation_result[section] = value
+                formatter = _SECTION_FORMATTERS.get(section)
+                if formatter is None:
+                    continue
+                yield format_sse_event(section, formatter(value))
+            yield format_sse_event('recommendations', _generate_recommendations(validation_result))
+            yield format_sse_event('done', {'overall_score': validation_result.get('overall_score')})
+        except Exception as e:
+            logging.error(f"串流摘要驗證失敗: {e}")
+            yield format_sse_event('error', {'detail': f"摘要驗證失敗: {str(e)}"})
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.post("/validate-summary/stream-json", response_model=ValidationResponse, summary="AI 摘要品質驗證（串流 JSON）")
+async def stream_json_validate_medical_summary(
+    request: ValidationRequest, 
+    current_user: User = Depends(require_doctor)
+):
+    """
+    以單一 JSON 文件回傳與 /validate-summary 相同結構的結果，但每個區段完成即寫出
+    
+    供無法處理 SSE 的用戶端使用：首位元組不必等待整份結果組裝完成。
+    中途失敗時仍會補上 error 欄位並結束物件，確保回應為合法 JSON。
+    """
+    logging.info(f"開始進行串流 JSON 摘要驗證 - 用戶: {current_user.username}")
+    
+    async def body_iter():
+        validation_result = {}
+        separator = b''
+        yield b'{'
+        try:
+            async for section, value in medical_validator.stream_validation(
+                transcript=request.transcript,
+                summary=request.summary
+            ):
+                validation_result[section] = value
+                formatter = _SECTION_FORMATTERS.get(section)
+                if formatter is None:
+                    continue
+                yield separator + _json_member(section, formatter(value))
+                separator = b','
+            yield separator + _json_member('recommendations', _generate_recommendations(validation_result))
+            yield b',' + _json_member('short_circuit', False) + b'}'
+        except Exception as e:
+            logging.error(f"串流 JSON 摘要驗證失敗: {e}")
+            yield separator + _json_member('error', f"摘要驗證失敗: {str(e)}") + b'}'
+    
+    return StreamingResponse(body_iter(), media_type="application/json")
+
+
 @router.post("/smart-modify", summary="AI 智能修改摘要")
 async def smart_modify_summary(
     request: SmartModifyRequest, 
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(require_doctor)
 ):
     """
     AI 智能修改醫療摘要
@@ -129,14 +216,16 @@ async def smart_modify_summary(
     2. 標記修改位置和類型
     3. 提供修改說明
     """
-    if current_user.role != "Doctor":
-        raise HTTPException(status_code=403, detail="權限不足，僅限醫生操作")
-    
     try:
         logging.info(f"開始進行 AI 智能修改 - 用戶: {current_user.username}")
         
-        # 正規化摘要 Markdown，確保格式正確（標題、粗體小節、空行）
-        normalized_summary = normalize_summary_markdown(request.summary)
+        # 正規化摘要 Markdown，確保格式正確（標題、粗體小節、空行）；快取以正規化後摘要為鍵以提高命中
+        normalized_summary = await _normalize_markdown(request.summary)
+        cache_key = _response_cache_key("smart_modify", request.transcript, normalized_summary)
+        cached = _response_cache_get(cache_key)
+        if cached is not None:
+            logging.info(f"AI 智能修改命中快取 - 用戶: {current_user.username}")
+            return cached
 
         # 執行 AI 智能修改
         modification_result = await medical_validator.smart_modify_summary(
@@ -152,7 +241,9 @@ async def smart_modify_summary(
         if isinstance(modification_result, dict):
             patched = modification_result.get('patched_summary')
             if isinstance(patched, str) and patched:
-                modification_result['patched_summary'] = normalize_summary_markdown(patched)
+                modification_result['patched_summary'] = await _normalize_markdown(patched)
+            if not modification_result.get('degraded'):
+                _response_cache_put(cache_key, modification_result)
         return modification_result
         
     except Exception as e:
@@ -160,89 +251,150 @@ async def smart_modify_summary(
         raise HTTPException(status_code=500, detail=f"AI 智能修改失敗: {str(e)}")
 
 
+async def _normalize_markdown(text: str) -> str:
+    """正規化摘要 Markdown；長文交由執行緒池處理，避免阻塞事件迴圈"""
+    if len(text) <= OFFLOAD_NORMALIZE_MIN_CHARS:
+        return normalize_summary_markdown(text)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, normalize_summary_markdown, text)
+
+
+# 以 C 實作的 attrgetter 一次取出多個屬性，取代逐欄 Python 屬性存取
+_get_validation_result_fields = attrgetter('level', 'message', 'category', 'suggestion')
+_HIGHLIGHT_FIELDS = ('text', 'start_pos', 'end_pos', 'category', 'confidence', 'importance')
+_get_highlight_fields = attrgetter(*_HIGHLIGHT_FIELDS)
+_ANOMALY_FIELDS = ('value', 'normal_range', 'severity', 'suggestion', 'position')
+_get_anomaly_fields = attrgetter(*_ANOMALY_FIELDS)
+
+
+def _format_validation_results(results: list) -> list:
+    """格式化事實一致性 / 遺漏提醒結果"""
+    return [
+        {
+            'level': level.value,
+            'message': message,
+            'category': category,
+            'suggestion': suggestion
+        }
+        for level, message, category, suggestion in map(_get_validation_result_fields, results)
+    ]
+
+
+def _format_highlights(highlights: list) -> list:
+    """格式化關鍵資訊高亮結果"""
+    return [dict(zip(_HIGHLIGHT_FIELDS, fields)) for fields in map(_get_highlight_fields, highlights)]
+
+
+def _format_anomalies(anomalies: list) -> list:
+    """格式化異常數值結果"""
+    return [dict(zip(_ANOMALY_FIELDS, fields)) for fields in map(_get_anomaly_fields, anomalies)]
+
+
+def _json_member(key: str, value: Any) -> bytes:
+    """序列化 JSON 物件中的單一成員（"key":value）"""
+    return f"{json.dumps(key)}:{json.dumps(value, ensure_ascii=False)}".encode("utf-8")
+
+
+# 串流驗證各區段的格式化函數；未列出的區段（如 modifications）不送出
+_SECTION_FORMATTERS = {
+    'fact_consistency': _format_validation_results,
+    'highlights': _format_highlights,
+    'missing_alerts': _format_validation_results,
+    'anomalies': _format_anomalies,
+    'overall_score': lambda score: score,
+}
+
+
+# 依各驗證區段的問題數量觸發的建議範本：(結果鍵, 範本, 描述格式)；description 於觸發時填入
+_COUNT_RECOMMENDATION_RULES = (
+    ('fact_consistency', {
+        'type': 'fact_consistency',
+        'priority': 'high',
+        'title': '事實一致性問題',
+        'description': None,
+        'actions': ('檢查症狀描述是否準確', '確認數值是否正確', '驗證診斷建議的合理性')
+    }, '發現 {count} 個事實一致性問題，建議重新檢查摘要內容'),
+    ('missing_alerts', {
+        'type': 'missing_information',
+        'priority': 'medium',
+        'title': '資訊遺漏提醒',
+        'description': None,
+        'actions': ('檢查是否包含所有重要症狀', '確認生命徵象完整性', '補充必要的病史資訊')
+    }, '可能遺漏 {count} 項重要資訊'),
+    ('anomalies', {
+        'type': 'anomalous_values',
+        'priority': 'high',
+        'title': '異常數值檢測',
+        'description': None,
+        'actions': ('重新確認數值準確性', '檢查測量單位', '考慮是否需要重新測量')
+    }, '發現 {count} 個異常數值'),
+)
+
+# 整體分數門檻（遞增）與對應建議：分數低於第 i 個門檻時套用第 i 個範本，達最高門檻則不提出
+_SCORE_THRESHOLDS = (70, 85)
+_SCORE_RECOMMENDATION_RULES = (
+    ({
+        'type': 'overall_quality',
+        'priority': 'critical',
+        'title': '摘要品質需要改善',
+        'description': None,
+        'actions': ('重新生成摘要', '手動檢查所有內容', '尋求同事協助審核')
+    }, '整體品質分數為 {score}，建議大幅修改摘要內容'),
+    ({
+        'type': 'overall_quality',
+        'priority': 'medium',
+        'title': '摘要品質可進一步提升',
+        'description': None,
+        'actions': ('檢查標記的問題', '補充遺漏資訊', '確認異常數值')
+    }, '整體品質分數為 {score}，建議進行小幅調整'),
+)
+
+
 def _generate_recommendations(validation_result: Dict[str, Any]) -> list:
     """生成改善建議"""
     recommendations = []
     
-    # 基於事實一致性問題的建議
-    fact_issues = validation_result.get('fact_consistency', [])
-    if fact_issues:
-        recommendations.append({
-            'type': 'fact_consistency',
-            'priority': 'high',
-            'title': '事實一致性問題',
-            'description': f'發現 {len(fact_issues)} 個事實一致性問題，建議重新檢查摘要內容',
-            'actions': ['檢查症狀描述是否準確', '確認數值是否正確', '驗證診斷建議的合理性']
-        })
-    
-    # 基於遺漏資訊的建議
-    missing_alerts = validation_result.get('missing_alerts', [])
-    if missing_alerts:
-        recommendations.append({
-            'type': 'missing_information',
-            'priority': 'medium',
-            'title': '資訊遺漏提醒',
-            'description': f'可能遺漏 {len(missing_alerts)} 項重要資訊',
-            'actions': ['檢查是否包含所有重要症狀', '確認生命徵象完整性', '補充必要的病史資訊']
-        })
-    
-    # 基於異常數值的建議
-    anomalies = validation_result.get('anomalies', [])
-    if anomalies:
-        recommendations.append({
-            'type': 'anomalous_values',
-            'priority': 'high',
-            'title': '異常數值檢測',
-            'description': f'發現 {len(anomalies)} 個異常數值',
-            'actions': ['重新確認數值準確性', '檢查測量單位', '考慮是否需要重新測量']
-        })
+    # 基於事實一致性問題、遺漏資訊與異常數值的建議
+    for key, template, description in _COUNT_RECOMMENDATION_RULES:
+        count = len(validation_result.get(key, []))
+        if count:
+            recommendations.append({**template, 'description': description.format(count=count)})
     
     # 基於整體分數的建議
     overall_score = validation_result.get('overall_score', 0)
-    if overall_score < 70:
-        recommendations.append({
-            'type': 'overall_quality',
-            'priority': 'critical',
-            'title': '摘要品質需要改善',
-            'description': f'整體品質分數為 {overall_score}，建議大幅修改摘要內容',
-            'actions': ['重新生成摘要', '手動檢查所有內容', '尋求同事協助審核']
-        })
-    elif overall_score < 85:
-        recommendations.append({
-            'type': 'overall_quality',
-            'priority': 'medium',
-            'title': '摘要品質可進一步提升',
-            'description': f'整體品質分數為 {overall_score}，建議進行小幅調整',
-            'actions': ['檢查標記的問題', '補充遺漏資訊', '確認異常數值']
-        })
+    tier = bisect.bisect_right(_SCORE_THRESHOLDS, overall_score)
+    if tier < len(_SCORE_RECOMMENDATION_RULES):
+        template, description = _SCORE_RECOMMENDATION_RULES[tier]
+        recommendations.append({**template, 'description': description.format(score=overall_score)})
     
     return recommendations
 
 
+# 驗證統計為固定內容，於模組載入時序列化一次，每次請求直接回傳位元組
+_VALIDATION_STATS_BYTES = json.dumps({
+    "ai_agent_status": "active",
+    "supported_validations": [
+        "事實一致性校驗",
+        "關鍵資訊高亮",
+        "潛在遺漏提醒", 
+        "異常數值標記"
+    ],
+    "validation_categories": [
+        "symptom_mismatch",
+        "value_error", 
+        "diagnosis_inconsistency",
+        "treatment_unfounded",
+        "vital_signs",
+        "lab_values",
+        "medications",
+        "symptoms",
+        "diagnosis",
+        "treatment"
+    ]
+}, ensure_ascii=False).encode("utf-8")
+
+
 @router.get("/validation-stats", summary="獲取驗證統計資訊")
-async def get_validation_stats(current_user: User = Depends(get_current_user)):
+async def get_validation_stats(current_user: User = Depends(require_doctor)):
     """獲取 AI Agent 驗證統計資訊"""
-    if current_user.role != "Doctor":
-        raise HTTPException(status_code=403, detail="權限不足，僅限醫生操作")
-    
-    return {
-        "ai_agent_status": "active",
-        "supported_validations": [
-            "事實一致性校驗",
-            "關鍵資訊高亮",
-            "潛在遺漏提醒", 
-            "異常數值標記"
-        ],
-        "validation_categories": [
-            "symptom_mismatch",
-            "value_error", 
-            "diagnosis_inconsistency",
-            "treatment_unfounded",
-            "vital_signs",
-            "lab_values",
-            "medications",
-            "symptoms",
-            "diagnosis",
-            "treatment"
-        ]
-    }
+    return Response(content=_VALIDATION_STATS_BYTES, media_type="application/json")
@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 
 class TranscriptData(BaseModel):
@@ -27,8 +27,7 @@ class User(BaseModel):
     role: str
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class PatientBase(BaseModel):
@@ -50,8 +49,7 @@ class Patient(BaseModel):
     created_at: datetime
     updated_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class DoctorBase(BaseModel):
@@ -71,8 +69,7 @@ class Doctor(BaseModel):
     created_at: datetime
     updated_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class TaskBase(BaseModel):
@@ -94,8 +91,7 @@ class Task(TaskBase):
     created_at: datetime
     appointment_id: Optional[int] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class AppointmentBase(BaseModel):
@@ -120,8 +116,7 @@ class Appointment(BaseModel):
     created_at: datetime
     updated_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class AppointmentForDoctor(BaseModel):
@@ -134,8 +129,7 @@ class AppointmentForDoctor(BaseModel):
     tasks: List[Task] = []
     summary: Optional[str] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class DashboardData(BaseModel):
@@ -165,24 +159,21 @@ class Prescription(PrescriptionCreate):
     appointment_id: Optional[int] = None
     medication_code: Optional[str] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class TaskForAppointmentDetail(BaseModel):
     description: str
     is_completed: bool
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class DoctorForAppointmentDetail(BaseModel):
     name: str
     specialty: str
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class AppointmentDetail(BaseModel):
@@ -193,8 +184,7 @@ class AppointmentDetail(BaseModel):
     tasks: List[TaskForAppointmentDetail] = []
     summary: Optional[str] = "AI 摘要功能開發中..."
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class AppointmentDetailForPatient(BaseModel):
@@ -208,8 +198,7 @@ class AppointmentDetailForPatient(BaseModel):
     appointment_type: str
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class SummaryUpdate(BaseModel):
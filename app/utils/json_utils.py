@@ -0,0 +1,11 @@
+from typing import Any
+
+from fastapi.responses import JSONResponse
+from pydantic_core import to_json
+
+
+class FastJSONResponse(JSONResponse):
+    """以 pydantic-core（Rust）編碼 JSON 的回應類別；輸出與 JSONResponse 相同為緊湊的 UTF-8"""
+
+    def render(self, content: Any) -> bytes:
+        return to_json(content)
@@ -1,12 +1,13 @@
-import re
+# 本模組型別標註完整，可直接以 mypyc 編譯為 C 擴充模組而不需修改原始碼
+from typing import FrozenSet, List
 
 
-SECTION_TITLES = [
+SECTION_TITLES: FrozenSet[str] = frozenset({
     "看診原因",
     "診斷結果",
     "治療計畫",
     "注意事項",
-]
+})
 
 
 def _normalize_line_endings(text: str) -> str:
@@ -21,13 +22,13 @@ def _normalize_line_endings(text: str) -> str:
     return text
 
 
-def _is_heading_variant(line: str, expected: str) -> bool:
-    s = line.strip()
-    # Remove markdown markers and trailing colons
-    s = re.sub(r"^[#*\s]+", "", s)
-    s = re.sub(r"[：:]+$", "", s)
-    s = s.strip()
-    return s == expected
+def _clean_heading(line: str) -> str:
+    # Remove markdown markers and trailing colons with C-level strips instead of the regex engine;
+    # markers may be interleaved with whitespace (e.g. "# **"), so strip both until neither remains
+    s: str = line.strip()
+    while s[:1] in ("#", "*"):
+        s = s.lstrip("#*").lstrip()
+    return s.rstrip("：:").strip()
 
 
 def normalize_summary_markdown(text: str) -> str:
@@ -41,76 +42,43 @@ def normalize_summary_markdown(text: str) -> str:
         return text
 
     text = _normalize_line_endings(text)
-    lines = text.split("\n")
-
-    # Determine if the first non-empty line is the summary title; if not, we will insert it
-    first_idx = 0
-    while first_idx < len(lines) and lines[first_idx].strip() == "":
-        first_idx += 1
-
-    result_lines = []
 
     # Always start with the standardized heading
-    result_lines.append("## 看診重點摘要")
-    result_lines.append("")
-
-    # Skip an existing variant of the title in the original
-    skip_first_line = False
-    if first_idx < len(lines):
-        first_line = lines[first_idx]
-        if _is_heading_variant(first_line, "看診重點摘要"):
-            skip_first_line = True
-
-    i = first_idx + (1 if skip_first_line else 0)
-
-    def append_blank_line_once():
-        if len(result_lines) == 0 or result_lines[-1] != "":
-            result_lines.append("")
-
-    while i < len(lines):
-        raw = lines[i]
-        stripped = raw.strip()
-
-        # Collapse excessive blank lines to a single blank
-        if stripped == "":
-            append_blank_line_once()
-            i += 1
+    result_lines: List[str] = ["## 看診重點摘要", ""]
+    seen_first: bool = False
+    prev_blank: bool = False
+
+    # Single pass: blank lines are only remembered (prev_blank) and flushed as one
+    # blank before the next content line, so runs of blanks collapse without a second pass
+    for raw in text.split("\n"):
+        stripped: str = raw.strip()
+        if not stripped:
+            prev_blank = True
             continue
 
-        # Normalize section headings to bold
-        matched_section = None
-        for title in SECTION_TITLES:
-            if _is_heading_variant(stripped, title):
-                matched_section = title
-                break
+        cleaned: str = _clean_heading(stripped)
 
-        if matched_section is not None:
-            # Ensure one blank line before a section (but avoid duplicating directly after title)
-            if len(result_lines) > 0 and result_lines[-1] != "":
+        # Skip an existing variant of the title on the first non-empty line
+        if not seen_first:
+            seen_first = True
+            if cleaned == "看診重點摘要":
+                continue
+
+        # Normalize section headings to bold, with one blank line before and after
+        if cleaned in SECTION_TITLES:
+            if result_lines[-1] != "":
                 result_lines.append("")
-            result_lines.append(f"**{matched_section}**")
+            result_lines.append(f"**{cleaned}**")
             result_lines.append("")
-            i += 1
-            # Skip following duplicate blank lines in source to avoid extra spacing
-            while i < len(lines) and lines[i].strip() == "":
-                i += 1
-            continue
-
-        # Normal content line: keep as-is (trim right whitespace only)
-        result_lines.append(raw.rstrip())
-        i += 1
+        else:
+            if prev_blank and result_lines[-1] != "":
+                result_lines.append("")
+            # Normal content line: keep as-is (trim right whitespace only)
+            result_lines.append(raw.rstrip())
+        prev_blank = False
 
-    # Trim extra blank lines at the end
-    while len(result_lines) > 0 and result_lines[-1] == "":
+    # Trim the trailing blank (at most one, since blanks are never emitted twice in a row)
+    if result_lines[-1] == "":
         result_lines.pop()
 
-    # Collapse any double blanks in the middle (ensure at most one)
-    collapsed = []
-    for line in result_lines:
-        if line == "" and len(collapsed) > 0 and collapsed[-1] == "":
-            continue
-        collapsed.append(line)
-
-    return "\n".join(collapsed)
-
-
+    return "\n".join(result_lines)
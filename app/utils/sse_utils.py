@@ -0,0 +1,27 @@
+import json
+from typing import Any, Callable
+
+
+# SSE 回應標頭：禁止快取，並要求 nginx 等反向代理不要緩衝，讓每個事件產生後立即送達瀏覽器
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+def format_sse_event(event: str, data: Any) -> str:
+    """組成單一 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def make_sse_field_formatter(event: str, field: str) -> Callable[[Any], str]:
+    """
+    為資料只有單一欄位的高頻事件預先組好固定的前後綴，每次只需編碼欄位值；
+    輸出與 format_sse_event(event, {field: value}) 完全相同
+    """
+    prefix = f"event: {event}\ndata: {{{json.dumps(field, ensure_ascii=False)}: "
+    suffix = "}\n\n"
+
+    def format_event(value: Any) -> str:
+        return prefix + json.dumps(value, ensure_ascii=False) + suffix
+
+    return format_event
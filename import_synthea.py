@@ -9,11 +9,27 @@ Created on Sun Aug 17 00:35:03 2025
 # -*- coding: utf-8 -*-
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+# ijson 可逐一串流解析 Bundle 內的 resource，不必先把整份數十 MB 的 JSON 載入記憶體；
+# 未安裝時退回 json.load（import ijson 會自動選用可用的 C 加速後端，如 yajl2_c）
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# 無法串流解析時，以 orjson 一次解析整份 Bundle（比標準庫 json 快數倍）；未安裝則用 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # --- 匯入我們在 main.py 中定義的 SQLAlchemy 元件 ---
 # 這讓我們可以在這個獨立的腳本中，操作與 FastAPI 應用相同的資料庫
 # *** 重要：請確保您的 main.py 檔案中有 PatientDB 這個類別 ***
+from sqlalchemy import text
+
 from main import SessionLocal, PatientDB
 
 # --------------------------------------------------------------------------
@@ -23,9 +39,81 @@ from main import SessionLocal, PatientDB
 # Path.home() 會自動找到您的個人資料夾 (例如 /Users/huyuwei)
 SYNTHEA_OUTPUT_DIR = Path.home() / "Desktop" / "synthea" / "output" / "fhir"
 
+# 每累積多少筆病患資料就以 executemany 寫入一次；每寫入多少筆提交一次，讓 WAL 得以 checkpoint
+INSERT_BATCH_SIZE = 1000
+COMMIT_EVERY_ROWS = 5000
+
+# 匯入期間套用的 SQLite 設定：WAL 免去每次交易的 fsync 屏障，並以較大的記憶體快取吸收寫入。
+# journal_mode=WAL 為持久設定且線上服務同樣適用，其餘為連線層級設定，匯入結束後還原
+SQLITE_IMPORT_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("temp_store", "MEMORY"),
+    ("cache_size", "-200000"),
+)
+SQLITE_RESTORED_PRAGMAS = ("synchronous", "temp_store", "cache_size")
+
+def iter_bundle_resources(file_path):
+    """逐一產生 FHIR Bundle 中每個 entry 的 resource"""
+    if ijson is not None:
+        with open(file_path, 'rb') as f:
+            yield from ijson.items(f, 'entry.item.resource')
+        return
+
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    if data.get("resourceType") == "Bundle" and "entry" in data:
+        for entry in data["entry"]:
+            yield entry.get("resource", {})
+
+
+GENDER_MAP = {
+    "male": "男性",
+    "female": "女性",
+    "other": "其他",
+    "unknown": "未知"
+}
+
+
+def parse_bundle(file_path):
+    """解析單一 Bundle 檔案，回傳可直接 bulk insert 的病患 dict 清單（於子行程中執行）"""
+    mappings = []
+    for resource in iter_bundle_resources(file_path):
+        if resource.get("resourceType") != "Patient":
+            continue
+
+        # 直接掃描並提早跳出，免去每筆病患建立 generator 的成本
+        name_data = None
+        for name in resource.get("name") or ():
+            if name.get("use") == "official":
+                name_data = name
+                break
+        if name_data:
+            first_name = " ".join(name_data.get("given", []))
+            last_name = name_data.get("family", "")
+            full_name = f"{last_name}{first_name}"
+        else:
+            continue
+
+        birth_date = resource.get("birthDate")
+        gender = GENDER_MAP.get(resource.get("gender", "unknown").lower())
+
+        if not all([full_name, birth_date, gender]):
+            continue
+
+        mappings.append({
+            "name": full_name,
+            "birthDate": birth_date,
+            "gender": gender,
+        })
+    return mappings
+
+
 def import_synthea_data():
     """
     解析 Synthea™ 產生的 FHIR JSON 檔案，並將病患資料匯入 SQLite 資料庫。
+    各檔案互不相依，JSON 解析以多行程平行處理；資料庫寫入留在主行程，避免 SQLite 鎖競爭。
     """
     print("--- 開始匯入 Synthea™ 合成資料 ---")
 
@@ -36,56 +124,46 @@ def import_synthea_data():
 
     db = SessionLocal()
     patient_count = 0
+    uncommitted_count = 0
+    buffer = []
+    previous_pragmas = {}
 
     try:
+        if db.get_bind().dialect.name == "sqlite":
+            for name, value in SQLITE_IMPORT_PRAGMAS:
+                previous_pragmas[name] = db.execute(text(f"PRAGMA {name}")).scalar()
+                db.execute(text(f"PRAGMA {name}={value}"))
+
         # 遍歷輸出目錄中的所有 JSON 檔案
-        for file_path in SYNTHEA_OUTPUT_DIR.glob("*.json"):
-            print(f"正在處理檔案: {file_path.name}")
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-
-                if data.get("resourceType") == "Bundle" and "entry" in data:
-                    for entry in data["entry"]:
-                        resource = entry.get("resource", {})
-                        
-                        if resource.get("resourceType") == "Patient":
-                            name_data = next((n for n in resource.get("name", []) if n.get("use") == "official"), None)
-                            if name_data:
-                                first_name = " ".join(name_data.get("given", []))
-                                last_name = name_data.get("family", "")
-                                full_name = f"{last_name}{first_name}"
-                            else:
-                                continue
-
-                            birth_date = resource.get("birthDate")
-                            
-                            gender_map = {
-                                "male": "男性",
-                                "female": "女性",
-                                "other": "其他",
-                                "unknown": "未知"
-                            }
-                            gender = gender_map.get(resource.get("gender", "unknown").lower())
-
-                            if not all([full_name, birth_date, gender]):
-                                continue
-
-                            db_patient = PatientDB(
-                                name=full_name,
-                                birthDate=birth_date,
-                                gender=gender
-                            )
-                            db.add(db_patient)
-                            patient_count += 1
-        
+        file_paths = list(SYNTHEA_OUTPUT_DIR.glob("*.json"))
+        with ProcessPoolExecutor() as executor:
+            for file_path, mappings in zip(file_paths, executor.map(parse_bundle, file_paths, chunksize=8)):
+                print(f"已處理檔案: {file_path.name}")
+                # 以 dict 暫存並批次寫入，略過 ORM 物件建立與逐筆 flush
+                buffer.extend(mappings)
+                patient_count += len(mappings)
+                if len(buffer) >= INSERT_BATCH_SIZE:
+                    db.bulk_insert_mappings(PatientDB, buffer)
+                    uncommitted_count += len(buffer)
+                    buffer.clear()
+                    if uncommitted_count >= COMMIT_EVERY_ROWS:
+                        db.commit()
+                        uncommitted_count = 0
+
         print("\n正在將所有資料寫入資料庫，請稍候...")
+        if buffer:
+            db.bulk_insert_mappings(PatientDB, buffer)
         db.commit()
         print(f"--- 匯入完成！總共新增了 {patient_count} 位病患資料。 ---")
 
     except Exception as e:
+        # 已分段提交的資料會保留，僅回復最後一段尚未提交的寫入
         print(f"\n發生錯誤：{e}")
         db.rollback()
     finally:
+        for name in SQLITE_RESTORED_PRAGMAS:
+            if name in previous_pragmas:
+                db.execute(text(f"PRAGMA {name}={previous_pragmas[name]}"))
         db.close()
 
 if __name__ == "__main__":
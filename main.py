@@ -3,12 +3,15 @@ import os
 import sys
 import logging
 import uvicorn
+from anyio import to_thread
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.config import ORIGINS
-from app.database import Base, engine
+from app.config import ORIGINS, THREADPOOL_SIZE
+from app.database import Base, engine, create_missing_indexes
+from app.utils.json_utils import FastJSONResponse
 from app.ai import init_ai_sdks
+from app.ai_agent import medical_validator
 from app.routers import auth as auth_router
 from app.routers import ai as ai_router
 from app.routers import patients as patients_router
@@ -24,7 +27,8 @@ from app.routers import validation as validation_router
 print("--- 應用程式啟動，版本 v5 ---", file=sys.stderr)
 
 
-app = FastAPI(title="智慧醫療資訊系統 API (V2 - 強化版)")
+# 預設回應改以 pydantic-core 編碼 JSON（未安裝 orjson，改用 pydantic 既有的 Rust 編碼器）
+app = FastAPI(title="智慧醫療資訊系統 API (V2 - 強化版)", default_response_class=FastJSONResponse)
 
 
 @app.on_event("startup")
@@ -32,15 +36,25 @@ def on_startup() -> None:
     try:
         logging.info("應用程式啟動，正在檢查並建立資料庫表格...")
         Base.metadata.create_all(bind=engine, checkfirst=True)
+        create_missing_indexes()
         logging.info("資料庫表格檢查完畢。")
         
         # 初始化 AI SDKs
         init_ai_sdks()
+        # 驗證器為全行程共用的單例，於此綁定模型，其底層連線由 SDK 跨請求重用
+        medical_validator.warm_up()
         logging.info("AI SDKs 初始化完成。")
     except Exception as e:
         logging.error(f"應用程式初始化失敗: {e}")
 
 
+@app.on_event("startup")
+async def configure_threadpool() -> None:
+    # 同步資料庫路由在執行緒池中執行，讓並行上限與資料庫連線池一致而非 anyio 預設的 40
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    logging.info(f"執行緒池大小設定為: {THREADPOOL_SIZE}")
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ORIGINS,